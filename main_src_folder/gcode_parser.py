@@ -0,0 +1,1266 @@
+# G-code parser used by script.py, no Blender dependency
+# https://github.com/apetsiuk/GCode-Parser-and-Viz
+
+
+import numpy as np
+import hashlib
+import mmap
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+#            PARSER
+#----------------------------------------------------------------------------
+MOVE_TYPES = ("G0", "G1", "G2", "G3")
+MOVE_CODES = {name: code for code, name in enumerate(MOVE_TYPES)}
+
+# G2/G3 arcs are stored as chords no further than this from the arc (mm)
+ARC_TOLERANCE = 0.02
+
+# mm, for the bead sizes from E
+FILAMENT_DIAMETER = 1.75
+
+# ;TYPE: codes stored per segment, 0 until the first known TYPE comment
+FEATURE_TYPES = ("NA", "Perimeter", "External perimeter", "Overhang perimeter",
+                 "Internal infill", "Solid infill", "Top solid infill", "Bridge infill",
+                 "Support material", "Support material interface",
+                 "Skirt/Brim", "Wipe tower", "Custom")
+TYPE_CODES = {name: code for code, name in enumerate(FEATURE_TYPES)}
+
+# groups used by the mesh props, FEATURE_GROUP maps a type code to its group
+FEATURE_NA, FEATURE_SHELL, FEATURE_FILL, FEATURE_SUPPORT = 0, 1, 2, 3
+FEATURE_NAMES = ("NA", "shell", "fill", "support")
+FEATURE_GROUP = np.array([FEATURE_NA,
+                          FEATURE_SHELL, FEATURE_SHELL, FEATURE_SHELL,
+                          FEATURE_FILL, FEATURE_FILL, FEATURE_FILL, FEATURE_FILL,
+                          FEATURE_SUPPORT, FEATURE_SUPPORT,
+                          FEATURE_NA, FEATURE_NA, FEATURE_NA], dtype=np.uint8)
+
+# bump when parsed output changes, cached parses of other versions are dropped
+PARSER_VERSION = 3
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "gcode_parser")
+CACHE_MAX_BYTES = 4 << 30
+
+MACHINE_STATE = ("X", "Y", "E", "F", "z_height", "layer_number", "feature")
+
+# style codes, 0 until classifySegments() runs
+STYLE_NONE, STYLE_TRAVEL, STYLE_EXTRUDE = 0, 1, 2
+STYLE_NAMES = (None, "travel", "extrude")
+
+
+class Segment:
+    def __init__(self,move_type,coords,layer_index,shell,fill,support,other):
+        self.type = move_type
+        self.coords = coords
+        self.layer_index = layer_index
+        self.shell = shell
+        self.fill = fill
+        self.support = support
+        self.other = other
+        self.style = None
+
+
+class SegmentTable:
+    # one typed array per column instead of one Segment object per move
+    COLUMNS = (("X", np.float64), ("Y", np.float64), ("Z", np.float64),
+               ("E", np.float64), ("F", np.float32),
+               ("layer", np.int32), ("move", np.uint8),
+               ("feature", np.uint8), ("style", np.uint8))
+
+    def __init__(self, capacity=4096):
+        self.size = 0
+        self.capacity = capacity
+        self.columns = {name: np.zeros(capacity, dtype) for name, dtype in self.COLUMNS}
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, name):
+        return self.columns[name][:self.size]
+
+    def reserve(self, n):
+        if self.size + n <= self.capacity:
+            return
+        # grow by doubling, np.zeros keeps the untouched tail out of memory
+        capacity = max(2*self.capacity, self.size + n)
+        for name, column in self.columns.items():
+            grown = np.zeros(capacity, column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.columns[name] = grown
+        self.capacity = capacity
+
+    def append(self, x, y, z, e, f, layer, move, feature):
+        if self.size == self.capacity:
+            self.reserve(1)
+        i = self.size
+        columns = self.columns
+        columns["X"][i] = x
+        columns["Y"][i] = y
+        columns["Z"][i] = z
+        columns["E"][i] = e
+        columns["F"][i] = f
+        columns["layer"][i] = layer
+        columns["move"][i] = move
+        columns["feature"][i] = feature
+        self.size += 1
+
+    def extend(self, **columns):
+        # bulk append, columns not given are left at zero
+        n = len(next(iter(columns.values())))
+        self.reserve(n)
+        for name, values in columns.items():
+            self.columns[name][self.size:self.size+n] = values
+        self.size += n
+
+    @classmethod
+    def fromColumns(cls, columns):
+        table = cls(0)
+        table.size = table.capacity = len(columns["X"])
+        table.columns = {name: np.ascontiguousarray(columns[name], dtype) for name, dtype in cls.COLUMNS}
+        return table
+
+    def view(self, start=0, stop=None):
+        return SegmentView(self, start, self.size if stop is None else stop)
+
+    def segment(self, i):
+        # materialize a single row as the old Segment object
+        columns = self.columns
+        coords = {"X": float(columns["X"][i]), "Y": float(columns["Y"][i]),
+                  "z_height": float(columns["Z"][i]), "E": float(columns["E"][i])}
+        feature = columns["feature"][i]
+        group = FEATURE_GROUP[feature]
+        seg = Segment(MOVE_TYPES[columns["move"][i]], coords, int(columns["layer"][i]),
+                      int(group == FEATURE_SHELL), int(group == FEATURE_FILL),
+                      int(group == FEATURE_SUPPORT), int(feature != 0 and group == FEATURE_NA))
+        seg.style = STYLE_NAMES[columns["style"][i]]
+        return seg
+
+
+class SegmentView:
+    # zero-copy window [start, stop) over a SegmentTable
+    # view["X"] gives the column slice, view[i] a Segment, view[a:b] a sub-view
+    def __init__(self, table, start, stop):
+        self.table = table
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.table.columns[key][self.start:self.stop]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("SegmentView slices must be contiguous")
+            return SegmentView(self.table, self.start+start, self.start+max(start, stop))
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("segment index out of range")
+        return self.table.segment(self.start+key)
+
+    def __iter__(self):
+        for i in range(self.start, self.stop):
+            yield self.table.segment(i)
+
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def evict_cache(cache_dir, max_bytes=None):
+    # drop entries written by other parser versions, then the least recently
+    # used ones until the directory fits in max_bytes
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    suffix = "-v%d.npz" % PARSER_VERSION
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if not name.endswith(".npz"):
+            continue
+        if not name.endswith(suffix):
+            os.remove(path)
+            continue
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+
+
+def type_feature(comment):
+    # type code for the text after ';', None keeps the current feature
+    return TYPE_CODES.get(comment[5:].strip())
+
+
+def type_bits(*names):
+    # bitmask over type codes, for select_types()
+    bits = 0
+    for name in names:
+        bits |= 1 << TYPE_CODES[name]
+    return bits
+
+
+# type bits of each group, in FEATURE_NAMES order
+GROUP_BITS = tuple(sum(1 << code for code in range(len(FEATURE_TYPES)) if FEATURE_GROUP[code] == group)
+                   for group in range(len(FEATURE_NAMES)))
+
+
+def select_types(features, bits):
+    # mask of the rows whose type code is set in bits
+    return ((np.uint32(bits) >> features.astype(np.uint32)) & 1).astype(bool)
+
+
+def group_masks(features):
+    # {"NA": mask, "shell": mask, "fill": mask, "support": mask}
+    return {name: select_types(features, GROUP_BITS[group]) for group, name in enumerate(FEATURE_NAMES)}
+
+
+def parse_line(line, state):
+    # one G-code line applied to a ParserState; returns (code, args) for
+    # command lines, None for blank and comment-only ones
+    command, commented, comment = line.partition(';')
+    if commented:
+        if comment[:12] == 'LAYER_CHANGE':
+            state.layer_number += 1
+        elif comment[:15] == 'LAYER_Z_HEIGHT=':
+            state.z_height = float(comment[15:])
+        elif comment[:5] == 'TYPE:':
+            feature = type_feature(comment)
+            if feature is not None:
+                state.feature = feature
+
+    comm = command.split(None, 1)
+    if not comm:
+        return None
+    code = comm[0] # G
+    args = comm[1] if (len(comm)>1) else None # XYEF
+    handler = COMMANDS.get(code)
+    if handler is not None:
+        handler(state, args, code)
+    return code,args
+
+
+def parse_args(args):
+    dic = {}
+    if args:
+        bits = args.split()
+        for bit in bits:
+            letter = bit[0]
+            try:
+                coord = float(bit[1:])
+            except ValueError:
+                coord = 1
+            dic[letter] = coord
+    return dic
+
+
+def do_move(state, args, move_type, force=False):
+    relative = state.relative
+    x, y = relative["X"], relative["Y"]
+    for axis in args.keys():
+        if axis in relative:
+            if state.isRelative:
+                relative[axis] += args[axis]
+            else:
+                relative[axis] = args[axis]
+
+    # only moves that change X or Y are stored
+    if (relative["X"] != x or relative["Y"] != y or force):
+        state.table.append(relative["X"], relative["Y"], state.z_height,
+                           args.get("E", 0), relative["F"], state.layer_number,
+                           MOVE_CODES[move_type], state.feature)
+    return relative
+
+
+def parse_move(state, args, code):
+    do_move(state, parse_args(args), code)
+
+
+def parse_arc(state, args, code):
+    # stored as one row at the end point like G1, the chords in between are
+    # added by ParserState.flushArcs(); an I/J arc ending where it starts is
+    # a full circle
+    args = parse_args(args)
+    x, y = state.relative["X"], state.relative["Y"]
+    row = len(state.table)
+    do_move(state, args, code, force=bool(args.get("I", 0) or args.get("J", 0)))
+    if len(state.table) > row:
+        state.arcs.append((row, x, y, args.get("I", np.nan), args.get("J", np.nan), args.get("R", np.nan)))
+
+
+# command code -> handler(state, args, code); any other code is skipped
+# without splitting its arguments
+COMMANDS = {"G0": parse_move, "G1": parse_move, "G2": parse_arc, "G3": parse_arc}
+
+
+def arc_centers(x0, y0, x1, y1, i, j, r, clockwise):
+    # centers of arcs from (x0, y0) to (x1, y1), NaN where neither I/J nor a
+    # usable R is given; R follows Marlin, negative for the long way round
+    # and the center on the chord when R is shorter than half of it
+    ij = ~np.isnan(i) | ~np.isnan(j)
+    cx = np.where(ij, x0 + np.nan_to_num(i), np.nan)
+    cy = np.where(ij, y0 + np.nan_to_num(j), np.nan)
+    dx, dy = x1 - x0, y1 - y0
+    d = np.hypot(dx, dy)
+    radius = ~ij & ~np.isnan(r) & (d > 0)
+    if radius.any():
+        dx, dy, d, r = dx[radius], dy[radius], d[radius], r[radius]
+        h = np.sqrt(np.maximum((r - 0.5*d) * (r + 0.5*d), 0.0))
+        e = np.where(clockwise[radius] ^ (r < 0), -1.0, 1.0)
+        cx[radius] = 0.5*(x0[radius] + x1[radius]) - e*h*dy/d
+        cy[radius] = 0.5*(y0[radius] + y1[radius]) + e*h*dx/d
+    return cx, cy
+
+
+def expand_arcs(columns, rows, x0, y0, i, j, r, tolerance=None):
+    # replace the arc rows of a column dict by chords within the tolerance;
+    # (x0, y0) is where each arc starts, the last chord ends on the stored
+    # point and E is split evenly over the chords (relative E)
+    tolerance = ARC_TOLERANCE if tolerance is None else tolerance
+    x, y = columns["X"], columns["Y"]
+    x1, y1 = x[rows], y[rows]
+    clockwise = columns["move"][rows] == MOVE_CODES["G2"]
+    cx, cy = arc_centers(x0, y0, x1, y1, i, j, r, clockwise)
+
+    ax, ay = x0 - cx, y0 - cy
+    bx, by = x1 - cx, y1 - cy
+    rho = np.hypot(ax, ay)
+    sweep = np.arctan2(ax*by - ay*bx, ax*bx + ay*by)
+    sweep = np.where(sweep < 0, sweep + 2*np.pi, sweep)
+    sweep = np.where(clockwise, sweep - 2*np.pi, sweep)
+    sweep = np.where((sweep == 0) & (x0 == x1) & (y0 == y1), 2*np.pi, sweep)
+    step = 2*np.arccos(np.clip(1 - tolerance / np.where(rho > 0, rho, 1.0), -1.0, 1.0))
+    step = np.minimum(step, 0.5*np.pi)
+    valid = (rho > 0) & np.isfinite(sweep)
+    chords = np.where(valid, np.ceil(np.abs(sweep) / np.where(valid, step, 1.0)), 1).astype(np.int64)
+    chords = np.maximum(chords, 1)
+
+    reps = np.ones(len(x), dtype=np.int64)
+    reps[rows] = chords
+    source = np.repeat(np.arange(len(x)), reps)
+    expanded = {name: column[source] for name, column in columns.items()}
+    expanded["E"] = expanded["E"] / reps[source]
+
+    # chords k = 1..n-1 of every arc end on the arc, the last one on the stored point
+    inner = chords - 1
+    arc = np.repeat(np.arange(len(rows)), inner)
+    k = np.arange(len(arc)) - np.repeat(np.cumsum(inner) - inner, inner) + 1
+    out = (np.cumsum(reps) - reps)[rows][arc] + k - 1
+    angle = np.arctan2(ay, ax)[arc] + sweep[arc] * k / chords[arc]
+    expanded["X"][out] = cx[arc] + rho[arc] * np.cos(angle)
+    expanded["Y"][out] = cy[arc] + rho[arc] * np.sin(angle)
+    return expanded
+
+
+def classify_styles(x, y, z, e, coords=(0.0, 0.0, 0.0)):
+    # extrude: some movement against the previous segment and positive E,
+    # travel otherwise; coords is the position before the first segment
+    moved = np.empty(len(x), dtype=bool)
+    if len(x):
+        moved[0] = (x[0], y[0], z[0]) != tuple(coords)
+        moved[1:] = (x[1:] != x[:-1]) | (y[1:] != y[:-1]) | (z[1:] != z[:-1])
+    return np.where(moved & (e > 0), STYLE_EXTRUDE, STYLE_TRAVEL).astype(np.uint8)
+
+
+def bead_sizes(segments, filament_diameter=None, z_below=0.0):
+    # width and height of the bead every extrude segment lays down, 0 for the
+    # others. E is taken as relative (M83) filament length; the bead is the
+    # slicer's flow shape, a rectangle with round ends, so its area is
+    # (width - height)*height + pi*height**2/4. A layer's height is its Z
+    # minus the one below, z_below for the first layer of segments. Widths
+    # stay between height (a round bead) and 4*height.
+    filament_diameter = FILAMENT_DIAMETER if filament_diameter is None else filament_diameter
+    x, y, z, e = segments["X"], segments["Y"], segments["Z"], segments["E"]
+    layer = segments["layer"]
+    n = len(x)
+    if n == 0:
+        return np.zeros(0, np.float32), np.zeros(0, np.float32)
+
+    last = np.flatnonzero(np.append(layer[1:] != layer[:-1], True))
+    height = np.repeat(np.diff(z[last], prepend=z_below), np.diff(last, prepend=-1))
+    length = np.zeros(n)
+    length[1:] = np.hypot(x[1:] - x[:-1], y[1:] - y[:-1])
+
+    extrude = (segments["style"] == STYLE_EXTRUDE) & (length > 0) & (height > 0)
+    area = np.zeros(n)
+    area[extrude] = e[extrude] * (0.25*np.pi*filament_diameter**2) / length[extrude]
+    width = np.zeros(n)
+    h = height[extrude]
+    width[extrude] = np.clip(area[extrude]/h + h*(1 - 0.25*np.pi), h, 4*h)
+    return width.astype(np.float32), np.where(extrude, height, 0).astype(np.float32)
+
+
+def segment_rates(segments, filament_diameter=None):
+    # feedrate (mm/s), volumetric flow (mm^3/s) and duration (s) of every
+    # segment, the move from the previous segment at its F (mm/min); E-only
+    # time and acceleration are left out. Flow is the filament E pushes per
+    # second, 0 for travel.
+    filament_diameter = FILAMENT_DIAMETER if filament_diameter is None else filament_diameter
+    x, y, z = segments["X"], segments["Y"], segments["Z"]
+    n = len(x)
+    length = np.zeros(n)
+    if n:
+        length[1:] = np.sqrt((x[1:] - x[:-1])**2 + (y[1:] - y[:-1])**2 + (z[1:] - z[:-1])**2)
+    feedrate = segments["F"].astype(np.float64) / 60
+    moving = (feedrate > 0) & (length > 0)
+    duration = np.zeros(n)
+    duration[moving] = length[moving] / feedrate[moving]
+    flow = np.zeros(n)
+    extrude = moving & (segments["style"] == STYLE_EXTRUDE)
+    flow[extrude] = segments["E"][extrude] * (0.25*np.pi*filament_diameter**2) / duration[extrude]
+    return feedrate.astype(np.float32), flow.astype(np.float32), duration.astype(np.float32)
+
+
+# simplify_segments() tolerances (mm) of the level-of-detail levels, 0 keeps
+# every point that isn't on a straight line
+LOD_TOLERANCES = (0.0, 0.005, 0.02, 0.05, 0.2)
+
+
+def douglas_peucker(points, starts, stops, tolerance):
+    # keep mask over points (n, 3) simplifying the polylines starts[k]..stops[k]
+    # (inclusive) so no dropped point is further than tolerance (one value or
+    # one per point) from the kept ones; all lines are split in one pass per
+    # recursion level
+    keep = np.zeros(len(points), dtype=bool)
+    keep[starts] = True
+    keep[stops] = True
+    tolerance = np.broadcast_to(np.asarray(tolerance, dtype=np.float64), len(points))
+    a, b = np.asarray(starts, np.int64), np.asarray(stops, np.int64)
+    while True:
+        inner = b - a - 1
+        a, b, inner = a[inner > 0], b[inner > 0], inner[inner > 0]
+        if len(a) == 0:
+            return keep
+        owner = np.repeat(np.arange(len(a)), inner)
+        offsets = np.cumsum(inner) - inner
+        index = a[owner] + 1 + np.arange(len(owner)) - offsets[owner]
+
+        # distance to the chord a..b, to a where the chord has no length
+        p0, p1 = points[a][owner], points[b][owner]
+        chord = p1 - p0
+        t = np.clip(np.einsum('ij,ij->i', points[index] - p0, chord) /
+                    np.maximum(np.einsum('ij,ij->i', chord, chord), 1e-24), 0, 1)
+        distance = np.linalg.norm(points[index] - (p0 + t[:, None]*chord), axis=1)
+
+        # split every chord at its furthest point if that is out of tolerance
+        furthest = np.maximum.reduceat(distance, offsets)
+        first = np.flatnonzero(distance == furthest[owner])
+        first = first[np.unique(owner[first], return_index=True)[1]]
+        split = furthest > tolerance[a]
+        m = index[first[split]]
+        keep[m] = True
+        a, b = np.concatenate((a[split], m)), np.concatenate((m, b[split]))
+
+
+def simplify_segments(segments, tolerance):
+    # segments with the interior points of every extrusion run (extrude
+    # segments of one layer, feature and F) thinned out: points on a straight
+    # line always go, then Douglas-Peucker keeps the rest within tolerance
+    # (mm, or an array indexed by layer number). The E of dropped segments
+    # moves to the next kept one, so bead sizes and flow see the same
+    # filament per run.
+    x, y, z = segments["X"], segments["Y"], segments["Z"]
+    n = len(x)
+    extrude = segments["style"] == STYLE_EXTRUDE
+    interior = np.zeros(n, dtype=bool)
+    if n > 2:
+        same = ((segments["layer"][1:] == segments["layer"][:-1]) &
+                (segments["feature"][1:] == segments["feature"][:-1]) &
+                (segments["F"][1:] == segments["F"][:-1]))
+        interior[1:-1] = extrude[1:-1] & extrude[2:] & same[1:]
+    points = np.column_stack((x, y, z))
+
+    # collinear merge: interior points on the line between their neighbours,
+    # going forward
+    candidate = interior.copy()
+    i = np.flatnonzero(interior)
+    ahead = points[i+1] - points[i]
+    behind = points[i] - points[i-1]
+    span = np.linalg.norm(points[i+1] - points[i-1], axis=1)
+    off = np.linalg.norm(np.cross(behind, ahead), axis=1) / np.maximum(span, 1e-12)
+    candidate[i[(off < 1e-6) & (np.einsum('ij,ij->i', behind, ahead) >= 0)]] = False
+
+    # Douglas-Peucker over what is left of every run
+    kept = np.flatnonzero(~interior | candidate)
+    inside = candidate[kept]
+    runs = np.flatnonzero(inside[1:] & ~inside[:-1])
+    ends = np.flatnonzero(inside[:-1] & ~inside[1:]) + 1
+    if np.ndim(tolerance):
+        tolerance = np.asarray(tolerance, dtype=np.float64)[segments["layer"][kept]]
+    keep = np.zeros(n, dtype=bool)
+    keep[kept[douglas_peucker(points[kept], runs, ends, tolerance)]] = True
+    keep[~interior] = True
+
+    index = np.flatnonzero(keep)
+    columns = {name: segments[name][index] for name, _ in SegmentTable.COLUMNS}
+    total = np.cumsum(segments["E"])[index]
+    columns["E"] = np.diff(total, prepend=total[:1] - segments["E"][index[:1]])
+    return SegmentTable.fromColumns(columns).view()
+
+
+def sample_layers(z, every=None, layers=None, z_range=None):
+    # numbers of the layers to render out of len(z) layers (parser.layers
+    # numbering, without layer 0): those in the `layers` list and within
+    # z_range (mm, by z, the Z of each layer's last segment or nan), then
+    # every k-th of them, counted so that every=10 keeps layers 10, 20, ...
+    z = np.asarray(z, dtype=np.float64)
+    numbers = np.arange(1, len(z))
+    if layers is not None:
+        numbers = numbers[np.isin(numbers, layers)]
+    if z_range is not None:
+        numbers = numbers[(z[numbers] >= z_range[0]) & (z[numbers] <= z_range[1])]
+    if every:
+        numbers = numbers[every-1::every]
+    return numbers
+
+
+def layer_bounds(layer):
+    # layer k spans rows [bounds[k], bounds[k+1]) of the non-decreasing layer column
+    if len(layer) == 0:
+        return np.zeros(1, dtype=np.int64)
+    return np.searchsorted(layer, np.arange(int(layer[-1]) + 2))
+
+
+# SegmentIndex grid cell size (mm)
+INDEX_CELL = 2.0
+
+
+class SegmentIndex:
+    # uniform XY grid per layer over the moves of a segment table; segment k
+    # is the move from row k-1 to row k of the layer, looked up by row k.
+    # Built in bulk, every query checks the exact geometry of the segments
+    # in the grid cells it touches.
+    def __init__(self, segments, cell=None, extrude_only=True):
+        self.cell = INDEX_CELL if cell is None else cell
+        self.x, self.y = segments["X"], segments["Y"]
+        layer = segments["layer"]
+        rows = np.flatnonzero(layer[1:] == layer[:-1]) + 1
+        if extrude_only:
+            rows = rows[segments["style"][rows] == STYLE_EXTRUDE]
+        self.x0 = float(min(self.x.min(), 0.0)) if len(self.x) else 0.0
+        self.y0 = float(min(self.y.min(), 0.0)) if len(self.y) else 0.0
+        self.nx = int((self.x.max() - self.x0) // self.cell) + 1 if len(self.x) else 1
+        self.ny = int((self.y.max() - self.y0) // self.cell) + 1 if len(self.y) else 1
+
+        # one entry per grid cell the bounding box of a segment covers
+        ax, ay = self.cellOf(self.x[rows-1], self.y[rows-1])
+        bx, by = self.cellOf(self.x[rows], self.y[rows])
+        cells, owner = self.cellRanges(layer[rows], np.minimum(ax, bx), np.minimum(ay, by),
+                                       np.maximum(ax, bx), np.maximum(ay, by))
+        order = np.argsort(cells, kind='stable')
+        self.keys, start = np.unique(cells[order], return_index=True)
+        self.start = np.append(start, len(order))
+        self.rows = rows[owner[order]]
+
+    def cellOf(self, x, y):
+        ix = np.clip(((np.asarray(x) - self.x0) // self.cell).astype(np.int64), 0, self.nx-1)
+        iy = np.clip(((np.asarray(y) - self.y0) // self.cell).astype(np.int64), 0, self.ny-1)
+        return ix, iy
+
+    def cellRanges(self, layer, ix0, iy0, ix1, iy1):
+        # keys of the cells in the boxes ix0..ix1 x iy0..iy1 (inclusive) of
+        # layer, and the box each key belongs to
+        w, h = ix1 - ix0 + 1, iy1 - iy0 + 1
+        count = w*h
+        owner = np.repeat(np.arange(len(count)), count)
+        k = np.arange(len(owner)) - np.repeat(np.cumsum(count) - count, count)
+        ix = ix0[owner] + k % w[owner]
+        iy = iy0[owner] + k // w[owner]
+        layer = np.broadcast_to(np.asarray(layer, dtype=np.int64), len(count))[owner]
+        return (layer*self.ny + iy)*self.nx + ix, owner
+
+    def candidates(self, layer, x0, y0, x1, y1, unique=True):
+        # (query, row) pairs of the segments in the cells of every query box,
+        # each pair once if unique
+        ix0, iy0 = self.cellOf(x0, y0)
+        ix1, iy1 = self.cellOf(x1, y1)
+        cells, query = self.cellRanges(layer, np.atleast_1d(ix0), np.atleast_1d(iy0),
+                                       np.atleast_1d(ix1), np.atleast_1d(iy1))
+        pos = np.minimum(np.searchsorted(self.keys, cells), max(len(self.keys)-1, 0))
+        found = (self.keys[pos] == cells) if len(self.keys) else np.zeros(len(cells), dtype=bool)
+        pos, query = pos[found], query[found]
+        count = self.start[pos+1] - self.start[pos]
+        first = np.repeat(self.start[pos] - (np.cumsum(count) - count), count)
+        rows = self.rows[first + np.arange(len(first))]
+        query = np.repeat(query, count)
+        if unique:
+            pairs = np.unique(query*len(self.x) + rows)
+            query, rows = pairs // len(self.x), pairs % len(self.x)
+        return query, rows
+
+    def distance(self, x, y, rows):
+        # distance from the points to the segments of rows
+        ax, ay = self.x[rows-1], self.y[rows-1]
+        dx, dy = self.x[rows] - ax, self.y[rows] - ay
+        t = np.clip(((x - ax)*dx + (y - ay)*dy) / np.maximum(dx*dx + dy*dy, 1e-24), 0, 1)
+        return np.hypot(x - ax - t*dx, y - ay - t*dy)
+
+    def box(self, layer, x0, y0, x1, y1):
+        # rows of the segments of layer crossing the box x0..x1, y0..y1
+        _, rows = self.candidates(layer, x0, y0, x1, y1)
+        ax, ay = self.x[rows-1], self.y[rows-1]
+        dx, dy = self.x[rows] - ax, self.y[rows] - ay
+        # Liang-Barsky: clip t in [0, 1] against the four sides
+        low, high = np.zeros(len(rows)), np.ones(len(rows))
+        keep = np.ones(len(rows), dtype=bool)
+        for p, q in ((-dx, ax - x0), (dx, x1 - ax), (-dy, ay - y0), (dy, y1 - ay)):
+            parallel = p == 0
+            keep &= ~(parallel & (q < 0))
+            t = q / np.where(parallel, 1, p)
+            low = np.where(~parallel & (p < 0), np.maximum(low, t), low)
+            high = np.where(~parallel & (p > 0), np.minimum(high, t), high)
+        return np.sort(rows[keep & (low <= high)])
+
+    def radius(self, layer, x, y, r):
+        # (point, row) pairs of the segments of layer within r of the points
+        # x, y (numbers or arrays)
+        x, y = np.atleast_1d(x).astype(np.float64), np.atleast_1d(y).astype(np.float64)
+        query, rows = self.candidates(layer, x - r, y - r, x + r, y + r)
+        near = self.distance(x[query], y[query], rows) <= r
+        return query[near], rows[near]
+
+    def nearest(self, layer, x, y):
+        # row of the segment of layer closest to each point and its distance,
+        # -1 and inf where the layer has none. Every point starts with the
+        # segments within one cell; the closest segment of the box is the
+        # answer if it lies within the box radius, otherwise its distance is
+        # the radius of the next search (twice the radius if the box was empty)
+        x, y = np.atleast_1d(x).astype(np.float64), np.atleast_1d(y).astype(np.float64)
+        best = np.full(len(x), -1, dtype=np.int64)
+        distance = np.full(len(x), np.inf)
+        todo = np.arange(len(x))
+        r = np.full(len(x), self.cell)
+        reach = self.cell*np.hypot(self.nx, self.ny) + np.hypot(x - self.x0, y - self.y0)
+        while len(todo):
+            tx, ty, tr = x[todo], y[todo], r[todo]
+            query, rows = self.candidates(layer, tx - tr, ty - tr, tx + tr, ty + tr, False)
+            d = self.distance(tx[query], ty[query], rows)
+            order = np.lexsort((d, query))
+            query, rows, d = query[order], rows[order], d[order]
+            first = np.flatnonzero(np.append(True, query[1:] != query[:-1])) if len(query) else query
+            closest = np.full(len(todo), np.inf)
+            closest[query[first]] = d[first]
+            done = closest <= tr
+            best[todo[query[first][done[query[first]]]]] = rows[first][done[query[first]]]
+            distance[todo[done]] = closest[done]
+            r[todo] = np.where(np.isfinite(closest), closest, 2*tr)
+            todo = todo[~done & (tr <= reach[todo])]
+        return best, distance
+
+
+class ParserState:
+    # everything parse_line() reads and writes: the machine state and the
+    # table moves are stored in; one per thread or pipeline
+    def __init__(self):
+        self.relative = {"X":0.0,"Y":0.0,"F":0.0,"E":0.0, "z_height":0.0}
+        self.isRelative = False
+        self.table = SegmentTable()
+        self.layer_number = 0
+        self.z_height = 0.0
+        self.feature = 0
+        self.arcs = []
+
+    def machineState(self):
+        # everything parse_line() carries from one line to the next
+        state = {axis: self.relative[axis] for axis in ("X", "Y", "E", "F")}
+        state["z_height"] = self.z_height
+        state["layer_number"] = self.layer_number
+        state["feature"] = self.feature
+        return state
+
+    def setMachineState(self, state):
+        for axis in ("X", "Y", "E", "F"):
+            self.relative[axis] = state[axis]
+        self.z_height = state["z_height"]
+        self.layer_number = state["layer_number"]
+        self.feature = state["feature"]
+
+    def restart(self):
+        # back to the machine state and empty table of a new parser
+        self.setMachineState(ParserState().machineState())
+        self.table = SegmentTable()
+        self.arcs = []
+
+    def flushArcs(self):
+        # tessellate the arcs stored since the last flush in one batch
+        if not self.arcs:
+            return
+        rows, x0, y0, i, j, r = (np.array(column) for column in zip(*self.arcs))
+        self.arcs = []
+        table = self.table
+        columns = expand_arcs({name: table[name] for name in table.columns}, rows.astype(np.int64), x0, y0, i, j, r)
+        self.table = SegmentTable.fromColumns(columns)
+
+
+class Parser(ParserState):
+
+    def __init__(self):
+        ParserState.__init__(self)
+        self.layers = []
+
+    @property
+    def segments(self):
+        return self.table.view()
+
+    def parseFile(self,path):
+        with open(path, 'r') as f:
+            self.lineNb = 0
+            for line in f:
+                self.lineNb += 1
+                parse_line(line.rstrip(), self)
+        self.flushArcs()
+
+    def scanFile(self,path):
+        # same result as parseFile(), read from the mmap'ed bytes in blocks
+        # and converted straight into the segment columns
+        if os.path.getsize(path) == 0:
+            return
+        size = len(self.table)
+        state = self.machineState()
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                buf = np.frombuffer(mm, dtype=np.uint8)
+                self.lineNb = 0
+                for start, stop in block_ranges(mm, 0, len(mm)):
+                    raw = scan_block(buf, start, stop)
+                    if raw is None:
+                        break
+                    self.lineNb += raw["lines"]
+                    columns, state = resolve_moves(raw, state, self.isRelative)
+                    self.table.extend(**columns)
+                del buf
+            finally:
+                mm.close()
+        if raw is None:
+            # indented commands, let the line parser handle the whole file
+            self.table.size = size
+            self.parseFile(path)
+            return
+        self.setMachineState(state)
+
+    def parseParallel(self,path,workers=None):
+        # scanFile() with the blocks scanned in a process pool; the chunks are
+        # cut at ;LAYER_CHANGE lines and stitched back here by replaying them
+        # in file order on the carried machine state
+        if os.path.getsize(path) == 0:
+            return
+        with open(path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                chunks = split_at_layers(mm, 4*(workers or os.cpu_count() or 1))
+        size = len(self.table)
+        state = self.machineState()
+        try:
+            with ProcessPoolExecutor(workers) as pool:
+                self.lineNb = 0
+                for raws in pool.map(scan_range, [path]*len(chunks), *zip(*chunks)):
+                    if any(raw is None for raw in raws):
+                        raise ValueError("indented commands")
+                    for raw in raws:
+                        self.lineNb += raw["lines"]
+                        columns, state = resolve_moves(raw, state, self.isRelative)
+                        self.table.extend(**columns)
+        except (BrokenProcessPool, OSError, ValueError):
+            # no usable pool, or a file the scanner can't read: parse serially
+            self.table.size = size
+            self.scanFile(path)
+            return
+        self.setMachineState(state)
+
+    def parseLayers(self,path,first,last=None):
+        # classified views of layers first..last (parser.layers numbering),
+        # parsed on their own by seeking through the sidecar layer index;
+        # self.table only holds these layers afterwards
+        last = first if last is None else last
+        self.layers = []
+        index = load_layer_index(path)
+        if index is None:
+            # indented commands, needs the line parser from the start
+            self.restart()
+            self.parseFile(path)
+            self.classifySegments()
+            return self.layers[first:last+1]
+
+        offsets = index["offset"]
+        last = min(last, len(offsets)-1)
+        if first > last:
+            return []
+        self.table = SegmentTable()
+        state = machine_state(index, first)
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                buf = np.frombuffer(mm, dtype=np.uint8)
+                stop = int(offsets[last+1]) if last+1 < len(offsets) else len(mm)
+                for a, b in block_ranges(mm, int(offsets[first]), stop):
+                    columns, state = resolve_moves(scan_block(buf, a, b), state, self.isRelative)
+                    self.table.extend(**columns)
+                del buf
+            finally:
+                mm.close()
+        self.setMachineState(state)
+
+        table = self.table
+        coords = (index["X"][first], index["Y"][first], index["last_z"][first])
+        table["style"][:] = classify_styles(table["X"], table["Y"], table["Z"], table["E"], coords)
+        bounds = layer_bounds(table["layer"])
+        return [table.view(bounds[min(k, len(bounds)-1)], bounds[min(k+1, len(bounds)-1)])
+                for k in range(first, last+1)]
+
+    def iter_layers(self,path):
+        # yields the same layers as parseFile() + classifySegments(), each one
+        # as soon as the next ;LAYER_CHANGE is read; only the layer being
+        # read is held in self.table. Every pass starts from the machine state
+        # of a fresh Parser, not where an earlier parse left off
+        self.restart()
+        coords = (0.0, 0.0, 0.0)
+        next_layer = 0
+        with open(path, 'r') as f:
+            self.lineNb = 0
+            for line in f:
+                self.lineNb += 1
+                layer_number = self.layer_number
+                parse_line(line.rstrip(), self)
+                if self.layer_number == layer_number:
+                    continue
+
+                # rows below the new layer number are final
+                self.flushArcs()
+                table = self.table
+                done = int(np.searchsorted(table["layer"], self.layer_number))
+                if done == 0:
+                    continue
+                self.table = SegmentTable()
+                self.table.extend(**{name: table[name][done:] for name in table.columns})
+                table.size = done
+                coords = yield from self.finishLayers(table, next_layer, coords)
+                next_layer = int(table["layer"][-1]) + 1
+
+        self.flushArcs()
+        table = self.table
+        self.table = SegmentTable()
+        if len(table):
+            yield from self.finishLayers(table, next_layer, coords)
+
+    def finishLayers(self, table, first, coords):
+        table["style"][:] = classify_styles(table["X"], table["Y"], table["Z"], table["E"], coords)
+        bounds = layer_bounds(table["layer"])
+        for k in range(first, len(bounds)-1):
+            yield table.view(bounds[k], bounds[k+1])
+        return (table["X"][-1], table["Y"][-1], table["Z"][-1])
+
+    def sampleLayers(self,every=None,layers=None,z_range=None):
+        # sample_layers() over the parsed layers
+        bounds = layer_bounds(self.table["layer"])[:len(self.layers)+1]
+        z = np.where(bounds[1:] > bounds[:-1], self.table["Z"][np.maximum(bounds[1:]-1, 0)], np.nan)
+        return sample_layers(z, every, layers, z_range)
+
+    def parseLine(self, line):
+        return parse_line(line, self)
+
+    def parseArgs(self, args):
+        return parse_args(args)
+
+    def parse_G0(self, args, move_type="G0"):
+        do_move(self, parse_args(args), move_type)
+
+    def parse_G1(self, args, move_type="G1"):
+        do_move(self, parse_args(args), move_type)
+
+    def do_G0_G1(self,args,move_type):
+        return do_move(self, args, move_type)
+
+    def classifySegments(self):
+        table = self.table
+        if len(table) == 0:
+            return
+        table["style"][:] = classify_styles(table["X"], table["Y"], table["Z"], table["E"])
+        self.splitLayers()
+        print('**Segment classification complete**')
+
+    def splitLayers(self):
+        table = self.table
+        bounds = layer_bounds(table["layer"])
+        self.layers = [table.view(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    def parseCached(self,path,cache_dir=None,workers=0):
+        # parse + classify, or load the result of an earlier run of the same
+        # file content, ARC_TOLERANCE and PARSER_VERSION from cache_dir
+        cache_dir = cache_dir or CACHE_DIR
+        entry = os.path.join(cache_dir, "%s-t%g-v%d.npz" % (file_digest(path), ARC_TOLERANCE, PARSER_VERSION))
+        if os.path.exists(entry):
+            with np.load(entry) as data:
+                self.table = SegmentTable.fromColumns({name: data[name] for name, _ in SegmentTable.COLUMNS})
+                self.setMachineState({key: data["state_"+key].item() for key in MACHINE_STATE})
+                self.lineNb = int(data["lines"])
+            os.utime(entry)
+            self.splitLayers()
+            return
+
+        if workers:
+            self.parseParallel(path, workers)
+        else:
+            self.scanFile(path)
+        self.classifySegments()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        state = self.machineState()
+        arrays = {name: self.table[name] for name in self.table.columns}
+        arrays.update({"state_"+key: np.array(state[key]) for key in MACHINE_STATE})
+        arrays["lines"] = np.array(getattr(self, "lineNb", 0))
+        # a temp file of its own, so processes filling the same entry at once
+        # don't write into each other's file before the rename
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp, entry)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        evict_cache(cache_dir)
+
+
+
+#            FAST SCANNER
+#----------------------------------------------------------------------------
+# Bytes-level reader behind Parser.scanFile(). Lines, ';' and the X/Y/E/F
+# words are located with array operations on the mmap'ed file and the
+# numbers are converted in bulk, no str is created per line.
+SCAN_BLOCK = 1 << 24
+EVENT_LAYER, EVENT_Z, EVENT_TYPE = 0, 1, 2
+
+SCAN_AXES = ("X", "Y", "E", "F")
+ARC_WORDS = ("I", "J", "R")
+POW10 = 10.0 ** np.arange(16)
+WHITESPACE = np.zeros(256, dtype=bool)
+WHITESPACE[[9, 10, 11, 12, 13, 32]] = True
+
+
+def block_ranges(mm, start, stop):
+    # split [start, stop) into ranges of about SCAN_BLOCK bytes ending on a newline
+    while start < stop:
+        end = mm.find(b'\n', min(start + SCAN_BLOCK, stop) - 1, stop)
+        end = stop if end < 0 else end + 1
+        yield start, end
+        start = end
+
+
+def starts_with(b, pos, end, prefix):
+    prefix = np.frombuffer(prefix, dtype=np.uint8)
+    found = pos + len(prefix) <= end
+    rows = np.flatnonzero(found)
+    found[rows] = (b[pos[rows, None] + np.arange(len(prefix))] == prefix).all(axis=1)
+    return found
+
+
+def parse_numbers(b, start, stop):
+    # float(b[start:stop]) for every word, 1 where float() fails like parseArgs()
+    # mantissa and decimal count are exact integers, so mantissa / 10**count
+    # rounds the same way float() does
+    n = len(start)
+    length = stop - start
+    mantissa = np.zeros(n, dtype=np.int64)
+    decimals = np.zeros(n, dtype=np.int64)
+    digits = np.zeros(n, dtype=np.int64)
+    dots = np.zeros(n, dtype=np.int64)
+    simple = np.ones(n, dtype=bool)
+    negative = np.zeros(n, dtype=bool)
+    for col in range(int(length.max()) if n else 0):
+        inside = col < length
+        c = np.take(b, start + col, mode='clip')
+        d = c - np.uint8(48)
+        digit = inside & (d < 10)
+        dot = inside & (c == 46)
+        if col == 0:
+            negative = inside & (c == 45)
+            simple &= ~inside | digit | dot | negative | (c == 43)
+        else:
+            simple &= ~inside | digit | dot
+        np.multiply(mantissa, 10, out=mantissa, where=digit)
+        np.add(mantissa, d, out=mantissa, where=digit)
+        decimals += digit & (dots > 0)
+        digits += digit
+        dots += dot
+    simple &= (dots <= 1) & (digits <= 15)
+
+    values = np.ones(n)
+    exact = simple & (digits > 0)
+    values[exact] = mantissa[exact] / POW10[decimals[exact]]
+    values[exact & negative] *= -1
+    for i in np.flatnonzero(~simple):
+        try:
+            values[i] = float(bytes(b[start[i]:stop[i]]))
+        except ValueError:
+            values[i] = 1
+    return values
+
+
+def scan_block(buf, start, stop):
+    # raw G0-G3 words and comment events of the lines in buf[start:stop];
+    # axes not given on a line are NaN, positions are absolute byte offsets
+    b = buf[start:stop]
+    n = len(b)
+    ends = np.flatnonzero(b == 10)
+    if n and (len(ends) == 0 or ends[-1] != n-1):
+        ends = np.append(ends, n)
+    starts = np.concatenate(([0], ends[:-1] + 1)) if len(ends) else ends
+
+    # the command part of a line ends at its first ';'
+    semis = np.flatnonzero(b == 59)
+    first = np.searchsorted(semis, starts)
+    commented = first < len(semis)
+    first = semis[np.minimum(first, len(semis)-1)] if len(semis) else ends
+    commented &= first < ends
+    code_end = np.where(commented, first, ends)
+
+    indented = np.flatnonzero((starts < code_end) & WHITESPACE[b[np.minimum(starts, n-1)]])
+    for i in indented:
+        if bytes(b[starts[i]:code_end[i]]).strip():
+            return None
+
+    events = []
+    features = {}
+    comment_start = first[commented] + 1
+    comment_line = starts[commented]
+    comment_end = ends[commented]
+    for kind, prefix in ((EVENT_LAYER, b'LAYER_CHANGE'), (EVENT_Z, b'LAYER_Z_HEIGHT='), (EVENT_TYPE, b'TYPE:')):
+        for i in np.flatnonzero(starts_with(b, comment_start, comment_end, prefix)):
+            if kind == EVENT_LAYER:
+                value = 0.0
+            elif kind == EVENT_Z:
+                value = float(bytes(b[comment_start[i]+len(prefix):comment_end[i]]))
+            else:
+                comment = bytes(b[comment_start[i]:comment_end[i]])
+                if comment not in features:
+                    features[comment] = type_feature(comment.decode('latin-1'))
+                value = features[comment]
+                if value is None:
+                    continue
+            events.append((comment_line[i], kind, value))
+    events.sort()
+
+    # G0-G3 lines: "G", the move digit, then whitespace or the end of the command
+    at = lambda i: b[np.minimum(i, n-1)]
+    moves = ((starts + 2 <= code_end) & (at(starts) == 71) & (at(starts+1) >= 48) & (at(starts+1) <= 51) &
+             ((starts + 2 == code_end) | WHITESPACE[at(starts+2)]))
+    move_start = starts[moves]
+    move_end = code_end[moves]
+
+    # words are runs of printable bytes, cut at ';'; the X/Y/E/F/I/J/R ones that
+    # start between the move code and the end of the command are kept
+    printable = (b > 32) & (b != 59)
+    edges = np.flatnonzero(printable[1:] != printable[:-1]) + 1
+    if printable[0]:
+        edges = np.concatenate(([0], edges))
+    if printable[-1]:
+        edges = np.append(edges, n)
+    word_start = edges[0::2]
+    word_end = edges[1::2]
+    letter = b[word_start]
+    axis_word = np.zeros(len(word_start), dtype=bool)
+    for axis in SCAN_AXES + ARC_WORDS:
+        axis_word |= letter == ord(axis)
+    word_start = word_start[axis_word]
+    word_end = word_end[axis_word]
+    letter = letter[axis_word]
+    line = np.searchsorted(move_start, word_start, side='right') - 1
+    in_command = (line >= 0) & (word_start < move_end[line]) & (word_start >= move_start[line] + 2)
+
+    raw = {"pos": move_start + start, "move": (b[move_start+1] - 48).astype(np.uint8),
+           "lines": len(starts), "stop": stop}
+    for axis in SCAN_AXES + ARC_WORDS:
+        sel = np.flatnonzero(in_command & (letter == ord(axis)))
+        column = np.full(len(move_start), np.nan)
+        column[line[sel]] = parse_numbers(b, word_start[sel]+1, word_end[sel])
+        raw[axis] = column
+    raw["events"] = (np.array([e[0] for e in events], dtype=np.int64) + start,
+                     np.array([e[1] for e in events], dtype=np.int64),
+                     np.array([e[2] for e in events], dtype=np.float64))
+    return raw
+
+
+def replay_moves(raw, state, isRelative=False):
+    # machine state after every move of a scan_block() result, replayed on
+    # top of the state the block starts in; "keep" marks the stored moves
+    pos = raw["pos"]
+    n = len(pos)
+    event_pos, event_kind, event_value = raw["events"]
+    moves = {}
+    for kind, key in ((EVENT_Z, "z_height"), (EVENT_TYPE, "feature")):
+        sel = event_kind == kind
+        at = np.searchsorted(event_pos[sel], pos, side='right')
+        moves[key] = np.append(state[key], event_value[sel])[at]
+    moves["layer_number"] = state["layer_number"] + np.searchsorted(event_pos[event_kind == EVENT_LAYER], pos, side='right')
+
+    for axis in SCAN_AXES:
+        given = ~np.isnan(raw[axis])
+        if isRelative:
+            moves[axis] = state[axis] + np.cumsum(np.where(given, raw[axis], 0.0))
+        else:
+            at = np.maximum.accumulate(np.where(given, np.arange(n), -1)) if n else np.zeros(0, dtype=np.int64)
+            moves[axis] = np.where(at >= 0, raw[axis][at], state[axis])
+
+    # only moves that change X or Y are stored, and I/J full circles
+    x, y = moves["X"], moves["Y"]
+    keep = np.ones(n, dtype=bool)
+    if n:
+        keep[0] = x[0] != state["X"] or y[0] != state["Y"]
+        keep[1:] = (x[1:] != x[:-1]) | (y[1:] != y[:-1])
+    keep |= (raw["move"] >= MOVE_CODES["G2"]) & ((np.nan_to_num(raw["I"]) != 0) | (np.nan_to_num(raw["J"]) != 0))
+    moves["keep"] = keep
+    return moves
+
+
+def states_before(raw, state, moves, offsets):
+    # machine state right before each byte offset inside the block, as arrays
+    pos = raw["pos"]
+    event_pos, event_kind, event_value = raw["events"]
+    done = np.searchsorted(pos, offsets)
+    states = {axis: np.append(state[axis], moves[axis])[done] for axis in SCAN_AXES}
+    for kind, key in ((EVENT_Z, "z_height"), (EVENT_TYPE, "feature")):
+        sel = event_kind == kind
+        states[key] = np.append(state[key], event_value[sel])[np.searchsorted(event_pos[sel], offsets)]
+    states["layer_number"] = state["layer_number"] + np.searchsorted(event_pos[event_kind == EVENT_LAYER], offsets)
+    return states
+
+
+def machine_state(states, i):
+    state = {key: float(states[key][i]) for key in MACHINE_STATE}
+    state["layer_number"] = int(state["layer_number"])
+    state["feature"] = int(state["feature"])
+    return state
+
+
+def resolve_moves(raw, state, isRelative=False):
+    # stored segment columns of a scan_block() result and the state at its end
+    moves = replay_moves(raw, state, isRelative)
+    keep = moves["keep"]
+    columns = {"X": moves["X"][keep], "Y": moves["Y"][keep], "Z": moves["z_height"][keep],
+               "E": np.where(np.isnan(raw["E"]), 0.0, raw["E"])[keep], "F": moves["F"][keep],
+               "layer": moves["layer_number"][keep], "move": raw["move"][keep],
+               "feature": moves["feature"][keep]}
+    arcs = np.flatnonzero(raw["move"][keep] >= MOVE_CODES["G2"])
+    if len(arcs):
+        moved = np.flatnonzero(keep)[arcs]
+        x0 = np.append(state["X"], moves["X"])[moved]
+        y0 = np.append(state["Y"], moves["Y"])[moved]
+        columns = expand_arcs(columns, arcs, x0, y0, raw["I"][moved], raw["J"][moved], raw["R"][moved])
+    return columns, machine_state(states_before(raw, state, moves, [raw["stop"]]), 0)
+
+
+def layer_change_offsets(mm, start=0, stop=None):
+    # byte offsets of the lines whose first comment is ;LAYER_CHANGE
+    stop = len(mm) if stop is None else stop
+    offsets = []
+    pos = mm.find(b';LAYER_CHANGE', start, stop)
+    while pos >= 0:
+        line = mm.rfind(b'\n', 0, pos) + 1
+        if mm.find(b';', line, pos) < 0:
+            offsets.append(line)
+        pos = mm.find(b';LAYER_CHANGE', pos + 1, stop)
+    return np.array(offsets, dtype=np.int64)
+
+
+def split_at_layers(mm, parts):
+    # about `parts` byte ranges of similar size, each starting at a layer change
+    offsets = layer_change_offsets(mm)
+    size = len(mm)
+    cuts = offsets[np.minimum(np.searchsorted(offsets, np.arange(1, parts) * size // parts), len(offsets)-1)] if len(offsets) else []
+    cuts = np.unique(np.concatenate(([0], np.asarray(cuts, dtype=np.int64), [size])))
+    return list(zip(cuts[:-1].tolist(), cuts[1:].tolist()))
+
+
+def scan_range(path, start, stop):
+    # process pool side of Parser.parseParallel()
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            buf = np.frombuffer(mm, dtype=np.uint8)
+            raws = [scan_block(buf, a, b) for a, b in block_ranges(mm, start, stop)]
+            del buf
+        finally:
+            mm.close()
+    return raws
+
+
+def build_layer_index(path):
+    # one scan recording, for every layer, the byte offset where it starts,
+    # the machine state there, the Z of the last stored segment before it
+    # (for classify_styles) and its own Z height; None for files the
+    # scanner can't read
+    if os.path.getsize(path) == 0:
+        return None
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offsets = np.concatenate(([0], layer_change_offsets(mm))).astype(np.int64)
+            buf = np.frombuffer(mm, dtype=np.uint8)
+            state = Parser().machineState()
+            last_z = 0.0
+            parts = []
+            for start, stop in block_ranges(mm, 0, len(mm)):
+                raw = scan_block(buf, start, stop)
+                if raw is None:
+                    break
+                moves = replay_moves(raw, state)
+                inside = offsets[(offsets >= start) & (offsets < stop)]
+                states = states_before(raw, state, moves, inside)
+                kept = np.flatnonzero(moves["keep"])
+                z = np.append(last_z, moves["z_height"][kept])
+                states["last_z"] = z[np.searchsorted(raw["pos"][kept], inside)]
+                parts.append(states)
+                last_z = z[-1]
+                state = machine_state(states_before(raw, state, moves, [stop]), 0)
+            del buf
+        finally:
+            mm.close()
+    if raw is None:
+        return None
+
+    index = {key: np.concatenate([part[key] for part in parts]) for key in MACHINE_STATE + ("last_z",)}
+    index["offset"] = offsets
+    # a layer's Z height is the one in effect when the next layer starts
+    index["z"] = np.append(index["z_height"][1:], state["z_height"])
+    return index
+
+
+def load_layer_index(path):
+    # the index from <path>.layers.npz, rebuilt when the G-code changed
+    sidecar = path + ".layers.npz"
+    stat = os.stat(path)
+    stamp = np.array([stat.st_size, stat.st_mtime_ns, PARSER_VERSION], dtype=np.int64)
+    if os.path.exists(sidecar):
+        with np.load(sidecar) as data:
+            if np.array_equal(data["stamp"], stamp):
+                return {key: data[key] for key in data.files if key != "stamp"}
+    index = build_layer_index(path)
+    if index is not None:
+        try:
+            with open(sidecar, 'wb') as f:
+                np.savez(f, stamp=stamp, **index)
+        except OSError:
+            pass
+    return index
+
+
+def layer_heights(path):
+    # Z height of every layer (parser.layers numbering) for sample_layers()
+    # before a file is streamed, from the sidecar layer index; files the
+    # scanner can't read are streamed once instead
+    index = load_layer_index(path)
+    if index is not None:
+        return index["z"]
+    return np.array([layer["Z"][-1] if len(layer) else np.nan for layer in Parser().iter_layers(path)])
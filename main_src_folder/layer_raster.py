@@ -0,0 +1,190 @@
+# Top-down images and label masks of G-code layers in NumPy, no Blender
+# dependency
+#
+#   python layer_raster.py print.gcode masks/ --size 512 --format png
+#
+# Every extrusion move is drawn as a bead (a line with round ends) of its
+# width; pixels get the label of the feature group that covers them last.
+# https://github.com/apetsiuk/GCode-Parser-and-Viz
+
+
+import argparse
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from gcode_parser import Parser, STYLE_EXTRUDE, FEATURE_GROUP, FEATURE_NAMES, bead_sizes
+
+
+#            RASTER
+#----------------------------------------------------------------------------
+# area drawn (x0, y0, x1, y1 in mm), the MK3S bed
+BED = (0.0, 0.0, 250.0, 210.0)
+# mm, where a bead has no width from its E
+BEAD_WIDTH = 0.45
+
+# label of every ;TYPE: code: 0 is background, FEATURE_NAMES[k] is k+1
+LABELS = (FEATURE_GROUP + 1).astype(np.uint8)
+# RGB of every label: background, NA, shell, fill, support
+PALETTE = np.array([(0, 0, 0), (128, 128, 128), (230, 60, 40),
+                    (250, 170, 40), (60, 120, 230)], dtype=np.uint8)
+
+# beads are cut into pieces this long (px) so each covers a small box
+PIECE = 4.0
+
+
+def rasterize(segments, region=BED, size=(512, 512), width=None, labels=None, out=None, z_below=0.0):
+    # label mask (height, width) of the extrusion moves of segments, one
+    # layer or a range of them seen from the top (later moves cover earlier
+    # ones). region is the mm box drawn into size = (width, height) pixels,
+    # row 0 at its top. width is the bead width in mm, the bead_sizes() one
+    # by default (z_below is the Z under the first layer of segments);
+    # labels maps ;TYPE: codes to values (LABELS by default). out is drawn
+    # into instead of a new zeroed array.
+    x0, y0, x1, y1 = region
+    w, h = size
+    if out is None:
+        out = np.zeros((h, w), dtype=np.uint8)
+    labels = LABELS if labels is None else np.asarray(labels)
+    x, y, layer = segments["X"], segments["Y"], segments["layer"]
+    rows = np.flatnonzero((layer[1:] == layer[:-1]) & (segments["style"][1:] == STYLE_EXTRUDE)) + 1
+    if len(rows) == 0:
+        return out
+
+    # pixel coordinates, y pointing down
+    sx, sy = w / (x1 - x0), h / (y1 - y0)
+    ax, ay = (x[rows-1] - x0)*sx, (y1 - y[rows-1])*sy
+    bx, by = (x[rows] - x0)*sx, (y1 - y[rows])*sy
+    if width is None:
+        width = bead_sizes(segments, z_below=z_below)[0][rows]
+        width = np.where(width > 0, width, BEAD_WIDTH)
+    radius = np.broadcast_to(np.maximum(0.5*np.asarray(width)*np.sqrt(sx*sy), 0.5), len(rows))
+    value = labels[segments["feature"][rows]]
+
+    # pieces of at most PIECE px along every bead
+    pieces = np.maximum(np.ceil(np.hypot(bx - ax, by - ay) / PIECE), 1).astype(np.int64)
+    owner = np.repeat(np.arange(len(rows)), pieces)
+    k = np.arange(len(owner)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    t0, t1 = k / pieces[owner], (k + 1) / pieces[owner]
+    dx, dy = (bx - ax)[owner], (by - ay)[owner]
+    px, py = ax[owner] + t0*dx, ay[owner] + t0*dy
+    qx, qy = ax[owner] + t1*dx, ay[owner] + t1*dy
+    r = radius[owner]
+
+    # every pixel of a piece's box whose centre is within r of the piece
+    left = np.clip(np.floor(np.minimum(px, qx) - r), 0, w).astype(np.int64)
+    right = np.clip(np.ceil(np.maximum(px, qx) + r), 0, w).astype(np.int64)
+    top = np.clip(np.floor(np.minimum(py, qy) - r), 0, h).astype(np.int64)
+    bottom = np.clip(np.ceil(np.maximum(py, qy) + r), 0, h).astype(np.int64)
+    bw, bh = right - left, bottom - top
+    count = bw*bh
+    piece = np.repeat(np.arange(len(count), dtype=np.int32), count)
+    k = np.arange(len(piece), dtype=np.int32) - np.repeat((np.cumsum(count) - count).astype(np.int32), count)
+    span = np.maximum(bw, 1).astype(np.int32)[piece]
+    ix = left.astype(np.int32)[piece] + k % span
+    iy = top.astype(np.int32)[piece] + k // span
+    # single precision is plenty at pixel scale and halves the memory traffic
+    px, py = px.astype(np.float32), py.astype(np.float32)
+    ex, ey = (qx.astype(np.float32) - px)[piece], (qy.astype(np.float32) - py)[piece]
+    cx, cy = ix + np.float32(0.5) - px[piece], iy + np.float32(0.5) - py[piece]
+    t = np.clip((cx*ex + cy*ey) / np.maximum(ex*ex + ey*ey, np.float32(1e-12)), 0, 1)
+    cx -= t*ex
+    cy -= t*ey
+    inside = cx*cx + cy*cy <= (r*r).astype(np.float32)[piece]
+
+    # the last bead over a pixel wins
+    pixel = (iy*w + ix)[inside]
+    last = len(pixel) - 1 - np.unique(pixel[::-1], return_index=True)[1]
+    out.ravel()[pixel[last]] = value[owner[piece[inside][last]]]
+    return out
+
+
+def colorize(mask, palette=None):
+    # RGB image of a label mask
+    return (PALETTE if palette is None else np.asarray(palette, dtype=np.uint8))[mask]
+
+
+def save_png(path, image):
+    # 8-bit grey (height, width) or RGB (height, width, 3) PNG
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    h, w = image.shape[:2]
+    kind = 2 if image.ndim == 3 else 0
+    raw = np.zeros((h, 1 + image[0].size), dtype=np.uint8) # filter byte 0 per row
+    raw[:, 1:] = image.reshape(h, -1)
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+    with open(path, 'wb') as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, kind, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b"IEND", b""))
+
+
+def layer_masks(parser, layers=None, cumulative=False, **options):
+    # (layer number, mask) for every layer of a classified parser (all but
+    # layer 0 by default); cumulative draws each on top of the ones before,
+    # the print so far seen from the top. options go to rasterize().
+    layers = range(1, len(parser.layers)) if layers is None else layers
+    mask = None
+    for n in layers:
+        below = parser.layers[n-1]["Z"] if n > 0 else []
+        z_below = float(below[-1]) if len(below) else 0.0
+        mask = rasterize(parser.layers[n], out=mask.copy() if cumulative and mask is not None else None,
+                         z_below=z_below, **options)
+        yield n, mask
+
+
+def write_masks(parser, folder, layers=None, fmt="png", colors=False, batch=100, **options):
+    # layer masks of layer_masks() into folder: layer_<n>.png per layer
+    # (colorize()d if colors), or for fmt "npy" one masks_<first>_<last>.npy
+    # stack of batch layers with their numbers in layers_<first>_<last>.npy;
+    # returns the files written
+    os.makedirs(folder, exist_ok=True)
+    written = []
+    stack, numbers = [], []
+
+    def flush():
+        name = "%04d_%04d.npy" % (numbers[0], numbers[-1])
+        np.save(os.path.join(folder, "masks_" + name), np.stack(stack))
+        np.save(os.path.join(folder, "layers_" + name), np.array(numbers, dtype=np.int32))
+        written.extend(os.path.join(folder, kind + name) for kind in ("masks_", "layers_"))
+        del stack[:], numbers[:]
+
+    for n, mask in layer_masks(parser, layers, **options):
+        if fmt == "npy":
+            stack.append(mask)
+            numbers.append(n)
+            if len(stack) == batch:
+                flush()
+        else:
+            path = os.path.join(folder, "layer_%04d.png" % n)
+            save_png(path, colorize(mask) if colors else mask)
+            written.append(path)
+    if stack:
+        flush()
+    return written
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser()
+    args.add_argument("gcode")
+    args.add_argument("output", help="folder the masks are written to")
+    args.add_argument("--size", type=int, nargs='+', default=[512], help="width [height] in pixels")
+    args.add_argument("--region", type=float, nargs=4, default=BED, help="x0 y0 x1 y1 in mm")
+    args.add_argument("--width", type=float, help="bead width in mm, from E by default")
+    args.add_argument("--layers", type=int, nargs=2, help="first and last layer")
+    args.add_argument("--format", choices=("png", "npy"), default="png")
+    args.add_argument("--colors", action="store_true", help="RGB PNGs instead of labels 0..%d" % len(FEATURE_NAMES))
+    args.add_argument("--cumulative", action="store_true", help="every layer on top of the ones below")
+    args = args.parse_args()
+
+    parser = Parser()
+    parser.parseCached(args.gcode)
+    layers = range(args.layers[0], args.layers[1]+1) if args.layers else None
+    size = (args.size[0], args.size[-1])
+    files = write_masks(parser, args.output, layers, args.format, args.colors,
+                        region=args.region, size=size, width=args.width, cumulative=args.cumulative)
+    print("%d files in %s" % (len(files), args.output))
@@ -0,0 +1,154 @@
+# Renders the bed x HDRI x layer frames of script.py in parallel `blender -b`
+# processes, no Blender dependency
+#
+#   python render_farm.py scene.blend renders/ --workers 8
+#
+# script.py is asked for the jobs once (--plan), the layers of every job are
+# cut into shards, each shard is rendered by its own Blender process into its
+# own folder (--shard/--output) and the images are moved into one folder.
+# Shards that fail or miss images are run again, and a rerun after a crash
+# only renders the images output doesn't have yet.
+# https://github.com/apetsiuk/GCode-Parser-and-Viz
+
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+
+#            FARM
+#----------------------------------------------------------------------------
+# TODO: change to the Blender executable if it isn't on the PATH
+BLENDER = "blender"
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "script.py")
+
+
+def run_blender(blend,args,threads,log):
+    # one background Blender on blend running script.py with args after "--";
+    # returns the exit code, the output goes to the log file
+    command = [BLENDER, "-b", blend, "-t", str(threads),
+               "--python-exit-code", "1", "--python", SCRIPT, "--"] + args
+    with open(log, 'w') as f:
+        return subprocess.call(command, stdout=f, stderr=subprocess.STDOUT)
+
+
+def plan_jobs(blend,work):
+    # the bed x HDRI jobs script.py would render, with their layer samples
+    path = os.path.join(work, "jobs.json")
+    if run_blender(blend, ["--plan", path], 0, os.path.join(work, "plan.log")) != 0:
+        raise RuntimeError("planning failed, see %s" % os.path.join(work, "plan.log"))
+    with open(path) as f:
+        return json.load(f)
+
+
+def shard_jobs(jobs,size):
+    # every job cut into runs of at most size samples; a shard starts its
+    # animation where the job would have reached that sample, so the frame
+    # numbers stay those of a single process render
+    shards = []
+    for job in jobs:
+        samples = job["samples"]
+        for k in range(0, len(samples), size):
+            shards.append([dict(job, start=job["start"]+k, samples=samples[k:k+size])])
+    return shards
+
+
+def image_name(job,layer):
+    # the file animate_layers() writes for layer of job
+    return "bed%d_hdri%d_L%d.png" % (job["bed"], job["hdri"], layer-1)
+
+
+def shard_images(shard):
+    return [image_name(job, layer) for job in shard for layer in job["samples"]]
+
+
+def render_shard(blend,work,output,number,shard,threads,retries):
+    # renders one shard in its own folder until all its images are there,
+    # then moves them to output; returns the missing images after the retries
+    folder = os.path.join(work, "shard%04d" % number)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, "shard.json")
+    with open(path, 'w') as f:
+        json.dump({"jobs": shard}, f)
+    images = shard_images(shard)
+    for attempt in range(retries+1):
+        log = os.path.join(folder, "try%d.log" % attempt)
+        code = run_blender(blend, ["--shard", path, "--output", folder], threads, log)
+        missing = [name for name in images if not os.path.exists(os.path.join(folder, name))]
+        if code == 0 and not missing:
+            break
+        print("shard %d failed (exit %d, %d images missing), see %s" % (number, code, len(missing), log))
+    for name in images:
+        if os.path.exists(os.path.join(folder, name)):
+            shutil.move(os.path.join(folder, name), os.path.join(output, name))
+    return missing
+
+
+def clean_work(work,shards,temporary):
+    # removes what a run wrote into work, all of it if it is its own
+    # temporary folder, anything else in a given --work folder stays
+    if temporary:
+        shutil.rmtree(work, ignore_errors=True)
+        return
+    for name in ("jobs.json", "plan.log"):
+        if os.path.exists(os.path.join(work, name)):
+            os.remove(os.path.join(work, name))
+    for number in range(shards):
+        shutil.rmtree(os.path.join(work, "shard%04d" % number), ignore_errors=True)
+
+
+def render_farm(blend,output,workers=None,shard_size=None,retries=2,work=None):
+    # renders every frame of script.py with workers Blender processes sharing
+    # the cores; returns the images that could not be rendered
+    if retries < 0:
+        raise ValueError("retries must be 0 or more, not %d" % retries)
+    workers = workers or os.cpu_count() or 1
+    threads = max(1, (os.cpu_count() or 1)//workers)
+    os.makedirs(output, exist_ok=True)
+    temporary = work is None
+    work = work or tempfile.mkdtemp(prefix="render_farm_")
+    os.makedirs(work, exist_ok=True)
+
+    jobs = plan_jobs(blend, work)
+    # resuming: images already collected in output are not rendered again,
+    # the scene table keeps the frames the same as in the first run
+    for job in jobs:
+        job["samples"] = [layer for layer in job["samples"]
+                          if not os.path.exists(os.path.join(output, image_name(job, layer)))]
+    if shard_size is None:
+        # about four shards per worker so a slow shard doesn't hold the rest
+        frames = sum(len(job["samples"]) for job in jobs)
+        shard_size = max(1, -(-frames//(4*workers)))
+    shards = shard_jobs(jobs, shard_size)
+    print("%d frames in %d shards on %d workers x %d threads" %
+          (sum(len(shard_images(shard)) for shard in shards), len(shards), workers, threads))
+
+    with ThreadPoolExecutor(workers) as pool:
+        results = pool.map(render_shard, [blend]*len(shards), [work]*len(shards), [output]*len(shards),
+                           range(len(shards)), shards, [threads]*len(shards), [retries]*len(shards))
+        missing = [name for names in results for name in names]
+    if not missing:
+        clean_work(work, len(shards), temporary)
+    return missing
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser()
+    args.add_argument("blend", help="scene the frames are rendered from")
+    args.add_argument("output", help="folder all images are collected in")
+    args.add_argument("--workers", type=int, help="Blender processes, the CPU count by default")
+    args.add_argument("--shard-size", type=int, help="frames per shard")
+    args.add_argument("--retries", type=int, default=2, help="reruns of a failed shard")
+    args.add_argument("--work", help="folder for the shards and logs, cleaned up unless anything fails")
+    args = args.parse_args()
+    if args.retries < 0:
+        sys.exit("--retries must be 0 or more")
+    missing = render_farm(args.blend, args.output, args.workers, args.shard_size, args.retries, args.work)
+    if missing:
+        print("%d images missing: %s" % (len(missing), ", ".join(missing[:10])))
+        sys.exit(1)
@@ -4,252 +4,133 @@
 
 import bpy
 import numpy as np
+import argparse
+import glob
+import importlib
+import json
 import math
+import os
 import random
+import sys
+from collections import OrderedDict
 
 
 #            PARSER
 #----------------------------------------------------------------------------
-class Segment:
-    def __init__(self,move_type,coords,layer_index,shell,fill,support,other):
-        self.type = move_type
-        self.coords = coords
-        self.layer_index = layer_index
-        self.shell = shell
-        self.fill = fill
-        self.support = support
-        self.other = other
-        self.style = None
-        
-        
-class Parser:
-
-    def __init__(self):
-        self.relative = {"X":0.0,"Y":0.0,"F":0.0,"E":0.0, "z_height":0.0}
-        self.isRelative = False
-        self.segments = []
-        self.layer_number = 0
-        self.z_height = 0.0
-        self.layers = []
-        self.shell = 0
-        self.fill = 0
-        self.support = 0
-        self.other = 0
-
-    def parseFile(self,path):
-        with open(path, 'r') as f:
-            self.lineNb = 0
-            for line in f:
-                self.lineNb += 1
-                self.line = line.rstrip()
-                self.parseLine()
-
-    def parseLine(self):
-        bits = self.line.split(';',1)
-        if(len(bits)>1):
-            if (bits[1][:12] == 'LAYER_CHANGE'):
-                self.layer_number += 1
-                #self.z_height += 0.3
-                
-        if(len(bits)>1):
-            if (bits[1][:15] == 'LAYER_Z_HEIGHT='):
-                self.z_height = float(bits[1][15:])
-
-        if(len(bits)>1):
-            if (bits[1][:20] == "TYPE:Internal infill" or
-                  bits[1][:17] == "TYPE:Solid infill" or
-                  bits[1][:21] == "TYPE:Top solid infill" or
-                  bits[1][:18] == "TYPE:Bridge infill"):
-                self.shell = 0
-                self.fill = 1
-                self.support = 0
-                self.other = 0
-            elif (bits[1][:14] == "TYPE:Perimeter" or
-                bits[1][:23] == "TYPE:External perimeter" or
-                bits[1][:23] == "TYPE:Overhang perimeter"):
-                self.shell = 1
-                self.fill = 0
-                self.support = 0
-                self.other = 0
-
-            elif (bits[1][:21] == "TYPE:Support material" or
-                  bits[1][:31] == "TYPE:Support material interface"):
-                self.shell = 0
-                self.fill = 0
-                self.support = 1
-                self.other = 0
-            '''else:
-                self.shell = 0
-                self.fill = 0
-                self.support = 0
-                self.other = 1'''
-
-        command = bits[0].strip()
-        comm = command.split(None, 1)
-        code = comm[0] if (len(comm)>0) else None # G
-        args = comm[1] if (len(comm)>1) else None # XYEF
-
-        if code:
-            if hasattr(self, "parse_"+code):
-                getattr(self, "parse_"+code)(args)
-                #print("code= ", code, ": args= ", args)
-            return code,args
-
-    def parseArgs(self, args):
-        dic = {}
-        if args:
-            bits = args.split()
-            for bit in bits:
-                letter = bit[0]
-                try:
-                    coord = float(bit[1:])
-                except ValueError:
-                    coord = 1
-                dic[letter] = coord
-        return dic
-
-    def parse_G0(self, args, move_type="G0"):
-        self.do_G0_G1(self.parseArgs(args), move_type)
-
-    def parse_G1(self, args, move_type="G1"):
-        self.do_G0_G1(self.parseArgs(args), move_type)
-
-    def do_G0_G1(self,args,move_type):
-        coords = dict(self.relative)
-        for axis in args.keys():
-            if axis in coords:
-                if self.isRelative:
-                    coords[axis] += args[axis]
-                else:
-                    coords[axis] = args[axis]
-        # build segment
-        absolute = {"X": coords["X"],"Y": coords["Y"],"z_height": self.z_height}
-        if "E" not in args : #"E" in coords:
-            absolute["E"] = 0
-        else:
-            absolute["E"] = args["E"]
-
-        seg = Segment(move_type,absolute,self.layer_number,self.shell,self.fill,self.support,self.other)
-
-        if (seg.coords['X'] != self.relative['X'] or
-            seg.coords['Y'] != self.relative['Y']):
-            self.segments.append(seg)
-        self.relative = coords
-        return self.relative
-
-    def classifySegments(self):
-        coords = {"X":0.0,"Y":0.0,"Z":0.0,"F":0.0,"E":0.0}
-        current_layer = 0
-        layer = []
-
-        for i, seg in enumerate(self.segments):
-            # default style is travel (move, no extrusion)
-            style = "travel"
-
-            # some horizontal movement, and positive extruder movement: extrusion
-            if (((seg.coords["X"] != coords["X"])
-                    or (seg.coords["Y"] != coords["Y"])
-                    or (seg.coords["z_height"] != coords["Z"])) and (seg.coords["E"]>0)): #!= coords["E"]
-                style = "extrude"
-
-            if i==len(self.segments)-1:
-                layer.append(seg)
-                current_layer += 1
-                seg.style = style
-                seg.layer_index = current_layer
-                self.layers.append(layer)
-                print('**Segment classification complete**')
-                break
-
-            if (self.segments[i].layer_index != current_layer):
-                self.layers.append(layer)
-                layer = []
-                current_layer+=1
-
-            # set style and layer in segment
-            seg.style = style
-            coords = seg.coords
-            layer.append(seg)
-            
-            
-            
+# TODO: change the folder that holds gcode_parser.py
+sys.path.append('C:/.../main_src_folder')
+import gcode_parser
+importlib.reload(gcode_parser)
+from gcode_parser import Parser, SegmentTable, sample_layers, STYLE_EXTRUDE, FEATURE_GROUP, FEATURE_NAMES, LOD_TOLERANCES, bead_sizes, segment_rates, simplify_segments
+
+
+
 #            Load and parse a file
 #----------------------------------------------------------------------------
 # TODO: change the file location          
+GCODE_PATH = 'C:/.../gcode_viz_0.4n_0.3mm_PLA_MK3SMMU2S_2h19m.gcode'
+# TODO: change the folder the renders are saved to
+RENDER_DIR = 'C:/...'
+# lights, bed, camera and material colours of every frame are drawn from this
+# seed into a table saved next to the renders (None: RENDER_DIR/scene_table.npz);
+# frames whose image exists are not rendered again
+SCENE_SEED = 0
+SCENE_TABLE = None
+
+# set by render_farm.py when this runs in a `blender -b` worker: --plan
+# writes the bed x HDRI jobs to a file and stops, --shard renders the jobs
+# of a shard file into --output
+farm_args = argparse.ArgumentParser()
+farm_args.add_argument("--plan")
+farm_args.add_argument("--shard")
+farm_args.add_argument("--output")
+FARM = farm_args.parse_args(sys.argv[sys.argv.index("--")+1:] if "--" in sys.argv else [])
+
+# read the file layer by layer instead of parsing it whole (parser.layers
+# stays empty); the Z of every layer for the sampling comes from the layer
+# index scan (gcode_parser.layer_heights)
+STREAM_LAYERS = False
+# parse with this many processes, 0 scans in Blender's own process
+PARSE_WORKERS = 0
+# reuse the parse of an unchanged file from earlier runs, None keeps the cache
+# in gcode_parser.CACHE_DIR
+USE_CACHE = True
+CACHE_DIR = None
+# TODO: set the filament diameter of the slicer profile (mm)
+gcode_parser.FILAMENT_DIAMETER = 1.75
+# G2/G3 arcs are split into chords no further than this from the arc (mm)
+gcode_parser.ARC_TOLERANCE = 0.02
+
 parser = Parser()
-parser.parseFile('C:/.../gcode_viz_0.4n_0.3mm_PLA_MK3SMMU2S_2h19m.gcode')
+if not STREAM_LAYERS:
+    if USE_CACHE:
+        parser.parseCached(GCODE_PATH, CACHE_DIR, PARSE_WORKERS)
+    else:
+        if PARSE_WORKERS:
+            parser.parseParallel(GCODE_PATH, PARSE_WORKERS)
+        else:
+            parser.scanFile(GCODE_PATH)
+        parser.classifySegments()
 
-parser.classifySegments()
-print(len(parser.segments))
-print(len(parser.layers))
+    print(len(parser.segments))
+    print(len(parser.layers))
 
-print(parser.layer_number)
-print(parser.z_height)
+    print(parser.layer_number)
+    print(parser.z_height)
+else:
+    layer_z = gcode_parser.layer_heights(GCODE_PATH)
+    print(len(layer_z))
 
 
 #            GCODE TO MESH IN BLENDER
 #----------------------------------------------------------------------------
 
+def extrusion_edges(segments):
+    # one edge from the previous segment to every extrude segment of the same
+    # layer; returns the mask of segments the edges use, the edges indexing
+    # into them, and the segment each edge ends on
+    style = segments["style"]
+    layer = segments["layer"]
+    ends = np.flatnonzero((style[1:] == STYLE_EXTRUDE) & (layer[1:] == layer[:-1])) + 1
+    used = np.zeros(len(style), dtype=bool)
+    used[ends-1] = True
+    used[ends] = True
+    index = np.cumsum(used, dtype=np.int32) - 1
+    edges = np.empty((len(ends), 2), dtype=np.int32)
+    edges[:, 0] = index[ends-1]
+    edges[:, 1] = index[ends]
+    return used, edges, ends
+
+
 def segments_to_meshdata(segments): # edges only on extrusion
-    segs = segments
-    verts=[]
-    edges=[]
-    props = []
-    
-    del_offset=0 # to travel segs in a row, one gets deleted, need to keep track of index for edges
-    for i in range(len(segs)):
-        # props.append(0)
-        if i>=len(segs)-1:
-            if segs[i].style == 'extrude':
-                verts.append([segs[i].coords['X'],segs[i].coords['Y'],segs[i].coords['z_height'] ])
-            break
-            
-            
-        # start of extrusion for first time
-        if segs[i].style == 'travel' and segs[i+1].style == 'extrude':
-            verts.append([segs[i].coords['X'],segs[i].coords['Y'],segs[i].coords['z_height'] ])
-            verts.append([segs[i+1].coords['X'],segs[i+1].coords['Y'],segs[i+1].coords['z_height'] ])
-            edges.append([i-del_offset,(i-del_offset)+1])
-            
-            if segs[i+1].fill == 1:
-                props.append('fill')
-            elif segs[i+1].shell == 1:
-                props.append('shell')
-            elif segs[i+1].support == 1:
-                props.append('support')
-            else:
-                props.append('NA')
-                
-
-        # mitte, current and next are extrusion, only add next, current is already in vert list
-        if segs[i].style == 'extrude' and segs[i+1].style == 'extrude':
-            verts.append([segs[i+1].coords['X'],segs[i+1].coords['Y'],segs[i+1].coords['z_height'] ])
-            edges.append([i-del_offset,(i-del_offset)+1])
-
-            if segs[i+1].fill == 1:
-                props.append('fill')
-            elif segs[i+1].shell == 1:
-                props.append('shell')
-            elif segs[i+1].support == 1:
-                props.append('support')
-            else:
-                props.append('NA')
- 
-        if segs[i].style == 'travel' and segs[i+1].style == 'travel':
-            del_offset+=1
-        
+    # verts are the segments the edges use, props the feature group of each edge
+    used, edges, ends = extrusion_edges(segments)
+    verts = np.empty((np.count_nonzero(used), 3), dtype=np.float32)
+    verts[:, 0] = segments["X"][used]
+    verts[:, 1] = segments["Y"][used]
+    verts[:, 2] = segments["Z"][used]
+    props = FEATURE_GROUP[segments["feature"][ends]]
     return verts, edges, props
 
 
 
 def obj_from_pydata(name,verts,edges,close,collection_name):
+    verts = np.asarray(verts, dtype=np.float32).reshape(-1, 3)
     if edges is None:
         # join vertices into one uninterrupted chain of edges.
-        edges = [[i, i+1] for i in range(len(verts)-1)]
+        chain = np.arange(len(verts), dtype=np.int32)
+        edges = np.column_stack((chain[:-1], chain[1:]))
         if close:
-            edges.append([len(verts)-1, 0]) # connect last to first
+            edges = np.vstack((edges, [[len(verts)-1, 0]])) # connect last to first
+    edges = np.asarray(edges, dtype=np.int32).reshape(-1, 2)
+
+    # bulk copy into the mesh buffers instead of from_pydata's per-element lists
     me = bpy.data.meshes.new(name)
-    me.from_pydata(verts, edges, [])   
+    me.vertices.add(len(verts))
+    me.vertices.foreach_set("co", verts.ravel())
+    me.edges.add(len(edges))
+    me.edges.foreach_set("vertices", edges.ravel())
+    me.update()
     obj = bpy.data.objects.new(name, me)
    
     # Move into collection if specified
@@ -262,6 +143,213 @@ def obj_from_pydata(name,verts,edges,close,collection_name):
             collection = bpy.data.collections.new(collection_name)
             bpy.context.scene.collection.children.link(collection) # link collection to main scene
             bpy.data.collections[collection_name].objects.link(obj) 
+    return obj
+
+
+def feature_attribute(obj,props):
+    # the feature group of every edge as the "feature" edge attribute, the
+    # material index of its tube after sweep_object()
+    obj.data.attributes.new("feature", 'INT', 'EDGE').data.foreach_set("value", np.asarray(props, dtype=np.int32))
+
+
+def edge_means(segments,columns):
+    # float point values from per-segment columns ({name: values}) for the
+    # mesh segments_to_meshdata() makes of segments; every edge takes the
+    # value of the segment it ends on and a vertex between two edges gets
+    # their mean
+    used, edges, ends = extrusion_edges(segments)
+    count = np.bincount(edges.ravel(), minlength=np.count_nonzero(used))
+    means = {}
+    for name, column in columns.items():
+        total = np.bincount(edges.ravel(), np.repeat(column[ends], 2), minlength=len(count))
+        means[name] = (total / np.maximum(count, 1)).astype(np.float32)
+    return means
+
+
+def point_attributes(segments,z_below):
+    # the float point attributes of the mesh of segments: "radius" and
+    # "radius_z", half the bead width and height, with BEAD_SIZES, and
+    # "feedrate" (mm/s), "flow" (mm^3/s) and "duration" (s) for heatmaps with
+    # RATE_ATTRIBUTES; also the rates at the edge ends for rate_highs()
+    columns, rates = {}, {}
+    if BEAD_SIZES:
+        width, height = bead_sizes(segments, z_below=z_below)
+        columns.update(radius=0.5*width, radius_z=0.5*height)
+    if RATE_ATTRIBUTES:
+        feedrate, flow, duration = segment_rates(segments)
+        ends = extrusion_edges(segments)[2]
+        rates = {"feedrate": feedrate[ends], "flow": flow[ends], "duration": duration[ends]}
+        columns.update(feedrate=feedrate, flow=flow, duration=duration)
+    return edge_means(segments,columns), rates
+
+
+def set_point_attributes(obj,points,rates):
+    # the point_attributes() on obj; an Attribute node in the material reads
+    # the rates, the top of their colour range goes to the object's
+    # "<name>_high", the 99th percentile so a few short segments with
+    # rounded E don't wash it out
+    for name, values in points.items():
+        obj.data.attributes.new(name, 'FLOAT', 'POINT').data.foreach_set("value", values)
+    for name, values in rates.items():
+        obj[name + "_high"] = float(np.percentile(values, 99)) if len(values) else 0.0
+
+
+def print_from_meshdata(name,pieces,collection_name):
+    # all layers in one object, made from (segments, z_below) pieces of
+    # whole layers one at a time so only the mesh arrays of the print are
+    # held; each vertex keeps its layer number in the "layer" attribute that
+    # process_print() filters on
+    verts, edges, props, layers = [], [], [], []
+    points, rates = {}, {}
+    last_layer = 0
+    for segments, z_below in pieces:
+        v, e, p = segments_to_meshdata(segments)
+        used = extrusion_edges(segments)[0]
+        edges.append(e + sum(len(part) for part in verts))
+        verts.append(v)
+        props.append(p)
+        layers.append(segments["layer"][used].astype(np.int32))
+        last_layer = int(segments["layer"][-1]) if len(segments) else last_layer
+        for values, parts in zip(point_attributes(segments,z_below), (points, rates)):
+            for key, value in values.items():
+                parts.setdefault(key, []).append(value)
+    verts = np.concatenate(verts) if verts else np.zeros((0, 3), np.float32)
+    edges = np.concatenate(edges) if edges else np.zeros((0, 2), np.int32)
+    obj = obj_from_pydata(name,verts,edges,False,collection_name)
+    feature_attribute(obj,np.concatenate(props) if props else [])
+    layer = obj.data.attributes.new("layer", 'INT', 'POINT')
+    layer.data.foreach_set("value", np.concatenate(layers) if layers else np.zeros(0, np.int32))
+    obj["last_layer"] = last_layer
+    set_point_attributes(obj,{key: np.concatenate(value) for key, value in points.items()},
+                         {key: np.concatenate(value) for key, value in rates.items()})
+    return obj
+
+
+def tube_meshdata(verts,edges,radius,sides,radius_z=None):
+    # sweep a `sides`-gon of the given radius along every chain of edges
+    # (an edge starting where the previous one ended continues the chain);
+    # radius and radius_z (vertical, defaults to radius) are numbers or one
+    # value per vert;
+    # returns the tube verts, the side quads, one cap polygon per chain end,
+    # for every tube vert the index of the vert it was swept from and for
+    # every polygon (quads, then caps) the edge it was swept along
+    verts = np.asarray(verts, dtype=np.float32).reshape(-1, 3)
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    if len(edges) == 0:
+        return (np.zeros((0, 3), np.float32), np.zeros((0, 4), np.int32),
+                np.zeros((0, sides), np.int32), np.zeros(0, np.int64), np.zeros(0, np.int64))
+
+    # path: the verts of all chains one after the other
+    starts = np.flatnonzero(np.concatenate(([True], edges[1:, 0] != edges[:-1, 1])))
+    path = np.insert(edges[:, 1], starts, edges[starts, 0])
+    first = starts + np.arange(len(starts))
+    last = np.append(first[1:], len(path)) - 1
+    points = verts[path]
+
+    # tangents: sum of the unit directions to and from each point, the next
+    # direction alone where the path turns back on itself
+    inner = np.ones(len(path)-1, dtype=bool)
+    inner[last[:-1]] = False
+    step = points[1:] - points[:-1]
+    length = np.linalg.norm(step, axis=1, keepdims=True)
+    unit = np.where(inner[:, None] & (length > 0), step / np.maximum(length, 1e-12), 0)
+    ahead = np.zeros_like(points)
+    behind = np.zeros_like(points)
+    ahead[:-1] = unit
+    behind[1:] = unit
+    tangent = ahead + behind
+    flat = np.linalg.norm(tangent, axis=1) < 1e-6
+    tangent[flat] = np.where(np.abs(ahead[flat]).sum(axis=1, keepdims=True) > 0, ahead[flat], behind[flat])
+    tangent /= np.maximum(np.linalg.norm(tangent, axis=1, keepdims=True), 1e-12)
+
+    # ring frame: side is horizontal, up completes it; vertical tangents use X
+    side = np.cross(tangent, (0.0, 0.0, 1.0))
+    upright = np.linalg.norm(side, axis=1) < 1e-6
+    side[upright] = np.cross(tangent[upright], (1.0, 0.0, 0.0))
+    side /= np.maximum(np.linalg.norm(side, axis=1, keepdims=True), 1e-12)
+    up = np.cross(side, tangent)
+
+    radius_z = radius if radius_z is None else radius_z
+    across = np.broadcast_to(np.asarray(radius, dtype=np.float64), len(verts))[path, None, None]
+    vertical = np.broadcast_to(np.asarray(radius_z, dtype=np.float64), len(verts))[path, None, None]
+    angle = 2*np.pi*np.arange(sides) / sides
+    offset = (across*np.cos(angle)[None, :, None]*side[:, None, :] +
+              vertical*np.sin(angle)[None, :, None]*up[:, None, :])
+    rings = (points[:, None, :] + offset).astype(np.float32)
+
+    # side quads between the rings of consecutive points of a chain, wound so
+    # the normals point away from the path
+    k = np.flatnonzero(inner)[:, None]*sides
+    j = np.arange(sides)[None, :]
+    nxt = (j + 1) % sides
+    quads = np.stack((k+j, k+sides+j, k+sides+nxt, k+nxt), axis=-1).reshape(-1, 4)
+
+    # caps get their own verts so they shade flat against the smooth sides
+    n = len(path)*sides
+    cap_rings = np.concatenate((rings[first], rings[last]))
+    caps = n + np.arange(len(cap_rings)*sides).reshape(-1, sides)
+    caps[len(first):] = caps[len(first):, ::-1]
+    tube = np.concatenate((rings.reshape(-1, 3), cap_rings.reshape(-1, 3)))
+    source = np.concatenate((np.repeat(path, sides), np.repeat(path[np.concatenate((first, last))], sides)))
+    # every edge is one step of the path, the caps close the first and last
+    # edge of their chain
+    face_edge = np.concatenate((np.repeat(np.arange(len(edges)), sides), starts,
+                                np.append(starts[1:], len(edges)) - 1))
+    return tube, quads.astype(np.int32), caps.astype(np.int32), source, face_edge
+
+
+def mesh_from_tubes(name,tube,quads,caps):
+    # tube_meshdata() output as a mesh, smooth sides and flat caps
+    faces = np.concatenate((quads.ravel(), caps.ravel())).astype(np.int32)
+    sizes = np.concatenate((np.full(len(quads), 4), np.full(len(caps), caps.shape[1]))).astype(np.int32)
+    me = bpy.data.meshes.new(name)
+    me.vertices.add(len(tube))
+    me.vertices.foreach_set("co", tube.ravel())
+    me.loops.add(len(faces))
+    me.loops.foreach_set("vertex_index", faces)
+    me.polygons.add(len(sizes))
+    me.polygons.foreach_set("loop_start", (np.cumsum(sizes) - sizes).astype(np.int32))
+    if bpy.app.version < (4, 0, 0):
+        me.polygons.foreach_set("loop_total", sizes)
+    me.polygons.foreach_set("use_smooth", np.arange(len(sizes)) < len(quads))
+    me.update(calc_edges=True)
+    return me
+
+
+def sweep_object(obj,radius):
+    # replace an edge mesh by its tubes, point attributes follow their vert
+    # and edge attributes become face attributes of the tube around the edge;
+    # the "radius" and "radius_z" attributes replace radius where present,
+    # the "feature" attribute sets the material index
+    old = obj.data
+    verts = np.empty(len(old.vertices)*3, dtype=np.float32)
+    old.vertices.foreach_get("co", verts)
+    edges = np.empty(len(old.edges)*2, dtype=np.int32)
+    old.edges.foreach_get("vertices", edges)
+    attributes = {}
+    for attr in old.attributes:
+        if attr.domain not in ('POINT', 'EDGE') or attr.data_type not in ('INT', 'FLOAT') or attr.name.startswith('.') or attr.name == 'position':
+            continue
+        values = np.empty(len(attr.data), dtype=np.int32 if attr.data_type == 'INT' else np.float32)
+        attr.data.foreach_get("value", values)
+        attributes[attr.name] = (attr.domain, attr.data_type, values)
+    radius_z = None
+    if "radius" in attributes:
+        radius = attributes["radius"][2]
+        radius_z = attributes.get("radius_z", (None, None, None))[2]
+    tube, quads, caps, source, face_edge = tube_meshdata(verts, edges, radius, TUBE_SIDES, radius_z)
+    me = mesh_from_tubes(old.name, tube, quads, caps)
+    for name, (domain, data_type, values) in attributes.items():
+        if domain == 'POINT':
+            me.attributes.new(name, data_type, 'POINT').data.foreach_set("value", values[source])
+        else:
+            me.attributes.new(name, data_type, 'FACE').data.foreach_set("value", values[face_edge])
+    if "feature" in attributes:
+        me.polygons.foreach_set("material_index", attributes["feature"][2][face_edge])
+    for mat in old.materials:
+        me.materials.append(mat)
+    obj.data = me
+    bpy.data.meshes.remove(old)
 #----------------------------------------------------------------------------
 
 
@@ -278,13 +366,13 @@ material_output.location = (500,200)
 # https://docs.blender.org/api/current/bpy.types.ShaderNode.html
 color_RGB_1 = gcode_mat.node_tree.nodes.new('ShaderNodeRGB')
 color_RGB_1.location = (-1800,700)
-#color_RGB_1.outputs[0].default_value = (1,0.105,0.034,1)
-color_RGB_1.outputs[0].default_value = (random.randint(1, 1000)/1000,random.randint(1, 1000)/1000,random.randint(1, 1000)/1000,1)
+# random colour from the scene table, set before rendering
+color_RGB_1.outputs[0].default_value = (1,0.105,0.034,1)
 
 color_RGB_2 = gcode_mat.node_tree.nodes.new('ShaderNodeRGB')
 color_RGB_2.location = (-1800,500)
-#color_RGB_2.outputs[0].default_value = (1,0.626,0.0767,1)
-color_RGB_2.outputs[0].default_value = (random.randint(1, 1000)/1000,random.randint(1, 1000)/1000,random.randint(1, 1000)/1000,1)
+# random colour from the scene table, set before rendering
+color_RGB_2.outputs[0].default_value = (1,0.626,0.0767,1)
 
 principled_node = gcode_mat.node_tree.nodes.new('ShaderNodeBsdfPrincipled')
 principled_node.location = (-850,250)
@@ -439,6 +527,53 @@ principled_node.inputs[20].default_value = 0.1
 # 19 - Alpha
 principled_node.inputs[21].default_value = 1
 #ShaderNodeBsdfPrincipled.subsurface_method = 'BURLEY'
+
+# one copy of the material per feature group, slot i holds FEATURE_NAMES[i]
+# so restyle "GCode shell" etc. to tell shells, infill and supports apart;
+# fake users keep them through purge_orphans()
+gcode_mat.use_fake_user = True
+feature_mats = []
+for name in FEATURE_NAMES:
+    mat = gcode_mat.copy()
+    mat.name = "GCode " + name
+    mat.use_fake_user = True
+    feature_mats.append(mat)
+
+
+def heatmap_material(name,high):
+    # colours by the point attribute name, blue at 0 to red at high
+    mat = bpy.data.materials.get("Heatmap " + name)
+    if mat is None:
+        mat = bpy.data.materials.new("Heatmap " + name)
+        mat.use_nodes = True
+        mat.use_fake_user = True
+        nodes = mat.node_tree.nodes
+        attribute = nodes.new('ShaderNodeAttribute')
+        attribute.attribute_name = name
+        attribute.location = (-900,300)
+        scale = nodes.new('ShaderNodeMapRange')
+        scale.location = (-700,300)
+        ramp = nodes.new('ShaderNodeValToRGB')
+        ramp.location = (-500,300)
+        ramp.color_ramp.elements[0].color = (0,0,1,1)
+        ramp.color_ramp.elements[1].color = (1,0,0,1)
+        ramp.color_ramp.elements.new(0.5).color = (0,1,0,1)
+        links = mat.node_tree.links
+        links.new(attribute.outputs["Fac"], scale.inputs["Value"])
+        links.new(scale.outputs["Result"], ramp.inputs["Fac"])
+        links.new(ramp.outputs["Color"], nodes["Principled BSDF"].inputs["Base Color"])
+    for node in mat.node_tree.nodes:
+        if node.type == 'MAP_RANGE':
+            node.inputs["From Max"].default_value = max(high, 1e-6)
+    return mat
+
+
+def print_materials(objs):
+    # the material slots of the print objects, one per feature group
+    if HEATMAP:
+        mat = heatmap_material(HEATMAP, max((obj.get(HEATMAP + "_high", 0.0) for obj in objs), default=0.0))
+        return [mat]*len(feature_mats)
+    return feature_mats
 #----------------------------------------------------------------------------
 
 
@@ -461,40 +596,134 @@ bpy.context.scene.node_tree.nodes.new("CompositorNodeOutputFile")
 #LN = 50
 #verts, edges, props = segments_to_meshdata(parser.layers[LN])
 
-for i in range(1,len(parser.layers)-0):
-    verts, edges, props = segments_to_meshdata(parser.layers[i])
-    print('-> verts and edges for L= ',i)
-
-    if(len(edges)>0):
-        obj_from_pydata('layer_'+str(i),verts,edges,True,"Layers")
-
-# TODO: Adjust the layer height ccording to slicer parameters
+# one mesh for the whole print instead of one object per layer; layers above
+# the current frame are hidden by process_print(). The layer objects flash
+# pass index 255 on the frame they appear, which the Object Index masks of
+# the compositor use; the single batched object can't, so it is off by default
+BATCHED_MESH = False
+# tube width and height of every bead from its E instead of LINE_HEIGHT
+BEAD_SIZES = True
+# "feedrate", "flow" and "duration" attributes on the print mesh; HEATMAP
+# colours the print by one of them instead of the G-code materials
+RATE_ATTRIBUTES = True
+HEATMAP = None # "feedrate", "flow" or "duration"
+# thin out the points of straight and gently curved extrusion runs: None
+# keeps every G1 step, a number is the tolerance in mm and "camera" picks one
+# of LOD_TOLERANCES per layer, the coarsest under half a pixel seen from the
+# closest camera
+SIMPLIFY = "camera"
+
+
+def layer_tolerances(segments,cameras):
+    # the "camera" tolerance of every layer number of segments, for camera
+    # positions (n, 3) aimed at the print around (120, 110)
+    layer = segments["layer"]
+    z = np.zeros(int(layer.max())+1 if len(layer) else 1)
+    np.maximum.at(z, layer, segments["Z"])
+    centre = np.column_stack((np.full(len(z), 120.0), np.full(len(z), 110.0), z))
+    distance = np.linalg.norm(cameras[:, None, :] - centre[None, :, :], axis=2).min(axis=0)
+    camera = bpy.data.collections['Collection'].objects['Camera'].data
+    render = bpy.context.scene.render
+    pixel = 2*math.tan(camera.angle/2) / (render.resolution_x*render.resolution_percentage/100)
+    level = np.searchsorted(LOD_TOLERANCES, 0.5*pixel*distance, side='right') - 1
+    return np.asarray(LOD_TOLERANCES)[np.maximum(level, 0)]
+
+
+def simplified(segments,cameras=None):
+    # segments at the SIMPLIFY level of detail; cameras are the positions the
+    # print is rendered from, the scene camera by default
+    if SIMPLIFY is None or len(segments) == 0:
+        return segments
+    if SIMPLIFY != "camera":
+        return simplify_segments(segments, SIMPLIFY)
+    if cameras is None:
+        cameras = [bpy.data.collections['Collection'].objects['Camera'].location]
+    return simplify_segments(segments, layer_tolerances(segments, np.asarray(cameras, dtype=np.float64).reshape(-1, 3)))
+
+
+# tube radius where BEAD_SIZES is off
 LINE_HEIGHT = 0.25
 
+# cross-section of the swept tubes
+TUBE_SIDES = 8
+
 def process_layers():
-    if(len(bpy.data.collections['Layers'].objects)>0):
-        for i in range(len(bpy.data.collections['Layers'].objects)):
-            obj = bpy.data.collections['Layers'].objects[i]
-            obj.select_set(True)
-            bpy.context.view_layer.objects.active = obj
-            bpy.ops.object.convert(target='CURVE')
-            bpy.context.object.data.bevel_depth=LINE_HEIGHT
-            bpy.context.object.data.use_fill_caps=True
-            bpy.ops.object.shade_smooth()
+    materials = print_materials(bpy.data.collections['Layers'].objects)
+    for obj in bpy.data.collections['Layers'].objects:
+        sweep_object(obj, LINE_HEIGHT)
+        so = obj
+        # place them at the initial invisible location
+        so.location[0] = 500 # 200
+        so.location[1] = 0
+        so.location[2] = -100 # -100
         
-            so = bpy.context.active_object
-            # place them at the initial invisible location
-            so.location[0] = 500 # 200
-            so.location[1] = 0
-            so.location[2] = -100 # -100
-            
-            so.data.materials.append(gcode_mat)
-            so.pass_index = 128
-            print('-> processed L= ',i)
-
-
-
-def camera_debug():
+        for mat in materials:
+            so.data.materials.append(mat)
+        so.pass_index = 128
+        print('-> processed',obj.name)
+
+
+def new_socket(group, in_out, socket_type, name):
+    if hasattr(group, "interface"): # Blender 4.0+
+        return group.interface.new_socket(name, in_out=in_out, socket_type=socket_type)
+    sockets = group.inputs if in_out == 'INPUT' else group.outputs
+    return sockets.new(socket_type, name)
+
+
+def show_layers_group():
+    # Geometry Nodes: drop points whose "layer" is above Max Layer
+    group = bpy.data.node_groups.get("Show Layers")
+    if group:
+        return group
+    group = bpy.data.node_groups.new("Show Layers", 'GeometryNodeTree')
+    new_socket(group, 'INPUT', 'NodeSocketGeometry', "Geometry")
+    max_layer = new_socket(group, 'INPUT', 'NodeSocketInt', "Max Layer")
+    new_socket(group, 'OUTPUT', 'NodeSocketGeometry', "Geometry")
+    nodes = group.nodes
+    links = group.links
+
+    group_in = nodes.new('NodeGroupInput')
+    group_out = nodes.new('NodeGroupOutput')
+    layer = nodes.new('GeometryNodeInputNamedAttribute')
+    layer.data_type = 'INT'
+    layer.inputs["Name"].default_value = "layer"
+    above = nodes.new('FunctionNodeCompare')
+    above.data_type = 'INT'
+    above.operation = 'GREATER_THAN'
+    delete = nodes.new('GeometryNodeDeleteGeometry')
+    delete.domain = 'POINT'
+
+    # these nodes have one socket per data type, only the INT ones are enabled
+    attribute = [socket for socket in layer.outputs if socket.enabled][0]
+    a, b = [socket for socket in above.inputs if socket.enabled]
+    links.new(attribute, a)
+    links.new(group_in.outputs[max_layer.name], b)
+    links.new(group_in.outputs["Geometry"], delete.inputs["Geometry"])
+    links.new(above.outputs["Result"], delete.inputs["Selection"])
+    links.new(delete.outputs["Geometry"], group_out.inputs["Geometry"])
+    group["max_layer"] = max_layer.identifier
+    return group
+
+
+def process_print(obj):
+    # process_layers() for the batched mesh: one tube mesh, and a Geometry
+    # Nodes modifier whose Max Layer follows the frame, so frame f shows
+    # layers 1..f without touching any object
+    sweep_object(obj, LINE_HEIGHT)
+    group = show_layers_group()
+    mod = obj.modifiers.new("Show Layers", 'NODES')
+    mod.node_group = group
+    driver = mod.driver_add('["%s"]' % group["max_layer"]).driver
+    driver.expression = "frame"
+    for mat in print_materials([obj]):
+        obj.data.materials.append(mat)
+    obj.pass_index = 128
+    print('-> processed layers 1 ..',obj["last_layer"])
+
+
+
+def camera_debug(seed=SCENE_SEED):
+    rand = random.Random(seed)
     s_cam = bpy.data.collections['Collection'].objects['Camera']
     s_cam.select_set(True)
     bpy.context.view_layer.objects.active = s_cam
@@ -510,9 +739,9 @@ def camera_debug():
     so.rotation_euler[1] = 0
     so.rotation_euler[2] = 0
     
-    so.location[0] = random.randint(10, 230)+0.1
-    so.location[1] = random.randint(10, 230)+0.1
-    so.location[2] = random.randint(20, 100)+0.1
+    so.location[0] = rand.randint(10, 230)+0.1
+    so.location[1] = rand.randint(10, 230)+0.1
+    so.location[2] = rand.randint(20, 100)+0.1
     
     
     angle_x_rad = math.atan((so.location[1]-origin_y)/(so.location[2]-origin_z))
@@ -526,131 +755,271 @@ def camera_debug():
     
             
 
-def animate_layers():
-    
-    ind = 0
+def keyframe_values(obj,data_path,frames,values,interpolation=0):
+    # one F-curve per channel of data_path, filled with all keys in one
+    # foreach_set; values has a row per frame. interpolation is the enum
+    # index, 0 = CONSTANT so every value holds until the next key
+    values = np.asarray(values, dtype=np.float32).reshape(len(frames), -1)
+    if obj.animation_data is None:
+        obj.animation_data_create()
+    action = obj.animation_data.action
+    if action is None:
+        action = bpy.data.actions.new(obj.name + "Action")
+        obj.animation_data.action = action
+    co = np.empty((len(frames), 2), dtype=np.float32)
+    co[:, 0] = frames
+    for index in range(values.shape[1]):
+        fc = action.fcurves.find(data_path, index=index)
+        if fc is None:
+            fc = action.fcurves.new(data_path, index=index)
+        fc.keyframe_points.clear()
+        fc.keyframe_points.add(len(frames))
+        co[:, 1] = values[:, index]
+        fc.keyframe_points.foreach_set("co", co.ravel())
+        fc.keyframe_points.foreach_set("interpolation", np.full(len(frames), interpolation, dtype=np.int32))
+        fc.update()
+
+
+# one row per rendered frame of the scene table
+FRAME_PARAMS = np.dtype([("bed", np.int32), ("hdri", np.int32), ("layer", np.int32),
+                         ("light_point", np.float64, 3), ("light_area", np.float64, 3),
+                         ("light_area_rot", np.float64), ("light_sun", np.float64, 3),
+                         ("bed_location", np.float64, 2), ("bed_rot", np.float64),
+                         ("camera", np.float64, 3)])
+
+
+def frame_params(samples,rng):
+    # random light, bed and camera placements of the frames showing samples,
+    # in the ranges the random.randint() calls used to draw from
+    n = len(samples)
+    def ints(low, high):
+        return rng.integers(low, high+1, n).astype(np.float64)
+    params = np.zeros(n, dtype=FRAME_PARAMS)
+    params["layer"] = samples
+    params["light_point"] = np.column_stack((ints(50, 230), ints(1, 190), ints(50, 180))) + 0.1
+    params["light_area"] = np.column_stack((ints(50, 230), ints(1, 190), ints(50, 180))) + 0.1
+    params["light_area_rot"] = ints(0, 200)/100 # radians (?)
+    params["light_sun"] = np.column_stack((ints(10, 350), ints(1, 320), ints(60, 300))) + 0.1
+    params["bed_location"] = np.column_stack((ints(90, 150), ints(80, 140))) + 0.1
+    params["bed_rot"] = ints(0, 200)/100
+    params["camera"] = np.column_stack((ints(10, 230)+0.1, ints(10, 230)+0.1,
+                                        np.asarray(samples)-1+10+ints(10, 30)+0.1))
+    return params
+
+
+def scene_table(jobs,seed):
+    # everything random in a render of jobs, drawn from seed: the two
+    # material colours, the bed plane pose (x, y, z rotation) of every bed
+    # texture and a FRAME_PARAMS row per frame
+    rng = np.random.default_rng(seed)
+    colors = rng.integers(1, 1001, (2, 3))/1000
+    n = len(bed_textire_list)
+    bed_poses = np.column_stack((rng.integers(90, 151, n)+0.1, rng.integers(80, 141, n)+0.1,
+                                 rng.integers(0, 201, n)/100))
+    frames = []
+    for job in jobs:
+        params = frame_params(job["samples"], rng)
+        params["bed"] = job["bed"]
+        params["hdri"] = job["hdri"]
+        frames.append(params)
+    frames = np.concatenate(frames) if frames else np.zeros(0, dtype=FRAME_PARAMS)
+    return {"seed": np.int64(seed), "beds": np.array(bed_textire_list, dtype=str),
+            "hdris": np.array(hdri_textire_list, dtype=str), "colors": colors,
+            "bed_poses": bed_poses, "frames": frames}
+
+
+def job_params(table,job):
+    # the scene table rows of job, in the order of its samples; None if the
+    # table lacks any of them
+    frames = table["frames"]
+    rows = frames[(frames["bed"] == job["bed"]) & (frames["hdri"] == job["hdri"])]
+    k = np.searchsorted(rows["layer"], job["samples"])
+    if np.any(k >= len(rows)) or np.any(rows["layer"][np.minimum(k, len(rows)-1)] != job["samples"]):
+        return None
+    return rows[k]
+
+
+def load_scene_table(path,jobs,seed,save=True):
+    # the table saved at path if it was drawn from seed for the same beds and
+    # HDRIs and covers jobs, otherwise a new one (saved if save); a run picks
+    # up the frame parameters of the run it resumes
+    if os.path.exists(path):
+        with np.load(path) as f:
+            table = dict(f)
+        if ("bed_poses" in table and table["seed"] == seed and list(table["beds"]) == bed_textire_list
+                and list(table["hdris"]) == hdri_textire_list
+                and all(job_params(table, job) is not None for job in jobs)):
+            return table
+    table = scene_table(jobs, seed)
+    if save:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", 'wb') as f:
+            np.savez(f, **table)
+        os.replace(path + ".tmp", path)
+    return table
+
+
+def animate_layers(start=0,samples=None,name="image",render_dir=None,params=None):
+    # frame start+k+1 shows the print up to layer samples[k] (every built
+    # layer by default) and is rendered to <render_dir>/<name>_L<layer-1>.png
+    # unless that image exists; lights, bed and camera are placed every frame
+    # from params (FRAME_PARAMS rows, random by default). All of it is keyed
+    # through the F-curve data, objects are found by their "last_layer"
+    layers = bpy.data.collections['Layers'].objects
+    if len(layers) == 0:
+        return
+    if samples is None:
+        if BATCHED_MESH:
+            samples = np.arange(1, layers[0]["last_layer"]+1)
+        else:
+            samples = sorted(obj["last_layer"] for obj in layers)
+    samples = np.asarray(samples)
+    if params is None:
+        params = frame_params(samples, np.random.default_rng())
+    paths = [os.path.join(render_dir or RENDER_DIR, f"{name}_L{layer-1}.png") for layer in samples]
+    todo = np.array([not os.path.exists(path) for path in paths], dtype=bool)
+    if not todo.any():
+        print('All {} images of {} exist'.format(len(samples), name))
+        return
+    n = len(samples)
+    frames = start + np.arange(1, n+1)
+
+    if BATCHED_MESH:
+        # Max Layer steps through the samples instead of following the frame
+        obj = layers[0]
+        mod = obj.modifiers["Show Layers"]
+        data_path = 'modifiers["%s"]["%s"]' % (mod.name, mod.node_group["max_layer"])
+        obj.driver_remove(data_path)
+        keyframe_values(obj, data_path, frames, samples)
+    else:
+        by_layer = {obj["last_layer"]: obj for obj in layers}
+        for frame, layer in zip(frames, samples):
+            obj = by_layer.get(layer)
+            if obj is None:
+                continue
+            # from the initial invisible location to the desired one, and
+            # pass index 255 on the frame the layer appears
+            keyframe_values(obj, "location", [frame-1, frame], [(500, 0, -100), (50, 55, 0)])
+            keyframe_values(obj, "pass_index", [frame-1, frame, frame+1], [128, 255, 128])
+        # a render farm shard can start mid print, the layers below its first
+        # sample are already in place
+        for obj in layers:
+            if obj["last_layer"] < samples[0]:
+                keyframe_values(obj, "location", frames[:1], [(50, 55, 0)])
+
+    # LIGHT MANIPULATION
+    objects = bpy.data.collections['Collection'].objects
+    keyframe_values(objects['Light_point'], "location", frames, params["light_point"])
+    area = objects['Light_area']
+    keyframe_values(area, "location", frames, params["light_area"])
+    keyframe_values(area, "rotation_euler", frames,
+                    np.column_stack((np.full(n, area.rotation_euler[0]), np.full(n, area.rotation_euler[1]),
+                                     params["light_area_rot"])))
+    keyframe_values(objects['Light_sun'], "location", frames, params["light_sun"])
+
+    # BED MANIPULATION
+    bed = objects['Bed']
+    keyframe_values(bed, "location", frames,
+                    np.column_stack((params["bed_location"], np.full(n, bed.location[2]))))
+    keyframe_values(bed, "rotation_euler", frames,
+                    np.column_stack((np.full(n, bed.rotation_euler[0]), np.full(n, bed.rotation_euler[1]),
+                                     params["bed_rot"])))
+
+    # CAMERA MANIPULATION, aimed at the origin where the gcode mesh is placed
+    origin_x = 120
+    origin_y = 110
+    origin_z = 0
+    cam_x, cam_y, cam_z = params["camera"].T
+    angle_x_rad = np.arctan((cam_y-origin_y)/(cam_z-origin_z))
+    angle_y_rad = np.arctan((cam_x-origin_x)/(cam_z-origin_z))
+    keyframe_values(objects['Camera'], "location", frames, np.column_stack((cam_x, cam_y, cam_z)))
+    keyframe_values(objects['Camera'], "rotation_euler", frames, np.column_stack((-angle_x_rad, angle_y_rad, np.zeros(n))))
+
     frame_count = 0
+    for frame, layer, path in zip(frames[todo], samples[todo], np.array(paths)[todo]):
+        i = layer-1
+        frame_count += 1
+        print('frame_count=',frame_count)
+        bpy.context.scene.frame_set(frame)
+        bpy.context.scene.render.filepath = path
+        bpy.ops.render.render(write_still=True)
     
-    if(len(bpy.data.collections['Layers'].objects)>0):
-        for i in range(len(bpy.data.collections['Layers'].objects)-0):
-            ind += 1
-            
-            obj = bpy.data.collections['Layers'].objects[i]
-            obj.select_set(True)
-            bpy.context.view_layer.objects.active = obj
-            so = bpy.context.active_object
-            
-            # place them at the desired location
-            so.location[0] = 50
-            so.location[1] = 55
-            so.location[2] = 0
-            so.pass_index = 255
-        
-            # origin - where you place the gcode mesh
-            origin_x = 120
-            origin_y = 110
-            origin_z = 0
-
-            so.keyframe_insert(data_path="location",frame=i+1)
-            bpy.data.scenes["Scene"].frame_current = i+1
-            #so.select_set(False)
-            #------------------------------------
-            
-            # LIGHT MANIPULATION
-            s_light_1 = bpy.data.collections['Collection'].objects['Light_point']
-            s_light_1.select_set(True)
-            bpy.context.view_layer.objects.active = s_light_1
-            so = bpy.context.active_object
-            # set light coordinates
-            so.location[0] = random.randint(50, 230)+0.1
-            so.location[1] = random.randint(1, 190)+0.1
-            so.location[2] = random.randint(50, 180)+0.1
-            
-            s_light_2 = bpy.data.collections['Collection'].objects['Light_area']
-            s_light_2.select_set(True)
-            bpy.context.view_layer.objects.active = s_light_2
-            so = bpy.context.active_object
-            # set light coordinates
-            so.location[0] = random.randint(50, 230)+0.1
-            so.location[1] = random.randint(1, 190)+0.1
-            so.location[2] = random.randint(50, 180)+0.1
-            so.rotation_euler[2] = random.randint(0, 200)/100 # radians (?)
-            
-            s_light_3 = bpy.data.collections['Collection'].objects['Light_sun']
-            s_light_3.select_set(True)
-            bpy.context.view_layer.objects.active = s_light_3
-            so = bpy.context.active_object
-            # set light coordinates
-            so.location[0] = random.randint(10, 350)+0.1
-            so.location[1] = random.randint(1, 320)+0.1
-            so.location[2] = random.randint(60, 300)+0.1
-            #------------------------------------
-            
-            # BED MANIPULATION
-            s_bed = bpy.data.collections['Collection'].objects['Bed']
-            s_bed.select_set(True)
-            bpy.context.view_layer.objects.active = s_bed
-            so = bpy.context.active_object
-            
-            # set bed coordinates
-            so.location[0] = random.randint(90, 150)+0.1
-            so.location[1] = random.randint(80, 140)+0.1
-            so.rotation_euler[2] = random.randint(0, 200)/100
-            s_bed.select_set(False)
-            
-            
-            #------------------------------------
-            
-            # CAMERA MANIPULATION
-            s_cam = bpy.data.collections['Collection'].objects['Camera']
-            s_cam.select_set(True)
-            bpy.context.view_layer.objects.active = s_cam
-            so = bpy.context.active_object
-            
-            # set camera angles to zero
-            so.rotation_euler[0] = 0
-            so.rotation_euler[1] = 0
-            so.rotation_euler[2] = 0
+        '''
+        mask_image = bpy.data.images['Viewer Node']
+        mask_image.filepath = f"C:/.../mask_L{i}.png"
+        mask_image.file_format = 'PNG'
+        mask_image.save()
+        '''
     
-            so.location[0] = random.randint(10, 230)+0.1
-            so.location[1] = random.randint(10, 230)+0.1
-            so.location[2] = i+10+random.randint(10, 30)+0.1
-    
-            angle_x_rad = math.atan((so.location[1]-origin_y)/(so.location[2]-origin_z))
-            angle_y_rad = math.atan((so.location[0]-origin_x)/(so.location[2]-origin_z))
-            so.rotation_euler[0] = (so.rotation_euler[0]-angle_x_rad)
-            so.rotation_euler[1] = (so.rotation_euler[1]+angle_y_rad)
-            #print(math.degrees(angle_x_rad))
-            print('Camera moved to ({},{},{}) m(?).'.format(so.location[0],so.location[1],so.location[2]))
-            
-            bpy.context.scene.render.filepath = f"C:/.../image_L{i}.png"
-            
-            if(ind % 10 == 0):
-                frame_count += 1
-                print('frame_count=',frame_count)
-                bpy.ops.render.render(write_still=True)
-            
-                '''
-                mask_image = bpy.data.images['Viewer Node']
-                mask_image.filepath = f"C:/.../mask_L{i}.png"
-                mask_image.file_format = 'PNG'
-                mask_image.save()
-                '''
-            
-                print('Saved {} out of {}'.format(i,len(bpy.data.collections['Layers'].objects)-1))
-            
-            # Set the pass index back to the original value
-            obj = bpy.data.collections['Layers'].objects[i]
-            obj.select_set(True)
-            bpy.context.view_layer.objects.active = obj
-            so = bpy.context.active_object
-            so.pass_index = 128
+        print('Saved {} out of {}'.format(i,samples[-1]-1))
     
 
 def del_collection(coll):
     for c in coll.children:
         del_collection(c)
     bpy.data.collections.remove(coll,do_unlink=True)
+
+
+#            RESOURCES
+#----------------------------------------------------------------------------
+# TODO: pixel memory the cached bed and HDRI images may use (bytes)
+IMAGE_CACHE_BYTES = 4 << 30
+image_cache = OrderedDict() # path -> image name, least recently used first
+
+def image_bytes(image):
+    width, height = image.size
+    return width*height*image.channels*(4 if image.is_float else 1)
+
+
+def cached_image(path):
+    # bpy.data.images.load() through an LRU keyed by path. Cached images keep
+    # a fake user so purge_orphans() leaves them alone; unused ones are
+    # removed, least recently used first, while the cache is over budget
+    name = image_cache.pop(path, None)
+    image = bpy.data.images.get(name) if name else None
+    if image is None:
+        image = bpy.data.images.load(path, check_existing=True)
+        image.use_fake_user = True
+    image_cache[path] = image.name
+
+    total = sum(image_bytes(bpy.data.images[n]) for n in image_cache.values() if n in bpy.data.images)
+    for old_path, old_name in list(image_cache.items())[:-1]:
+        if total <= IMAGE_CACHE_BYTES:
+            break
+        old = bpy.data.images.get(old_name)
+        if old is None:
+            del image_cache[old_path]
+        elif old.users <= 1: # only the fake user
+            total -= image_bytes(old)
+            del image_cache[old_path]
+            bpy.data.images.remove(old)
+    return image
+
+
+def purge_orphans():
+    # datablocks left without users by removed objects and collections
+    if hasattr(bpy.data, "orphans_purge"):
+        bpy.data.orphans_purge(do_local_ids=True, do_linked_ids=True, do_recursive=True)
+    else:
+        bpy.ops.outliner.orphans_purge(do_recursive=True)
+
+
+def bed_plane(path):
+    # the bed is one imported plane whose texture is swapped for every bed
+    # image, rescaled along X to the new image's aspect ratio
+    image = cached_image(path)
+    obj = bpy.data.objects.get("Bed Plane")
+    if obj is None:
+        bpy.ops.import_image.to_plane(shader='SHADELESS', files=[{'name':path}])
+        obj = bpy.context.active_object
+        obj.name = "Bed Plane"
+        obj["aspect"] = image.size[0] / image.size[1]
+        obj["x_scale"] = 1.0
+    for node in obj.active_material.node_tree.nodes:
+        if node.type == 'TEX_IMAGE':
+            node.image = image
+    obj["x_scale"] = image.size[0] / image.size[1] / obj["aspect"]
+    return obj
     
     
 # ---- BED Texture ----
@@ -664,51 +1033,19 @@ for filename in glob.glob('C:/.../GCODE_VIZ_BLENDER/_FOR_TRAINING/_environments/
     hdri_textire_list.append(filename)
 
 
-#--------------------------------------------------
-keyframe_runner = 1
-for i in range(len(bed_textire_list)): # BED Texture
-    bpy.ops.import_image.to_plane(shader='SHADELESS', files=[{'name':bed_textire_list[i]}])
-    bed_name = {'name':bed_textire_list[i]}["name"]
-    print('BED_NAME=',bed_name)
-    # whole file path - ".jpg"
-    bed_name = bed_name[len('C:/.../GCODE_VIZ_BLENDER/_FOR_TRAINING/_beds/'):-4]
-
-    #s_bed = bpy.data.collections['Collection'].objects[str(bed_name)]
-    s_bed = bpy.data.objects[str(bed_name)]
-    s_bed.select_set(True)
-    bpy.context.view_layer.objects.active = s_bed
-    so = bpy.context.active_object
-    # set coordinates and scale
-    so.location[0] = random.randint(90, 150)+0.1
-    so.location[1] = random.randint(80, 140)+0.1
-    so.location[2] = 0
-    
-    #so.location[2] = -600
-    #so.location[2] = -600
-    #so.location[2] = -600
-    
-    so.rotation_euler[0] = 0 # radians (?)
-    so.rotation_euler[2] = random.randint(0, 200)/100
-    #so.scale = (190,190,190)
-    so.scale = (250,250,250)
-    s_bed.select_set(False)
-    
-        
-    for j in range(len(hdri_textire_list)): # HDRI Env.
-        keyframe_runner += 1
-        C = bpy.context
-        scn = C.scene
-        # Get the environment node tree of the current scene
-        node_tree = scn.world.node_tree
-        tree_nodes = node_tree.nodes
+def set_environment(path):
+    # world: Environment Texture -> Background -> World Output; the nodes are
+    # made once and only the image changes
+    node_tree = bpy.context.scene.world.node_tree
+    tree_nodes = node_tree.nodes
+    node_environment = tree_nodes.get("Environment Texture")
+    if node_environment is None:
         # Clear all nodes
         tree_nodes.clear()
         # Add Background node
         node_background = tree_nodes.new(type='ShaderNodeBackground')
         # Add Environment Texture node
         node_environment = tree_nodes.new('ShaderNodeTexEnvironment')
-        # Load and assign the image to the node property
-        node_environment.image = bpy.data.images.load(hdri_textire_list[j]) # Relative path
         node_environment.location = -300,0
         # Add Output node
         node_output = tree_nodes.new(type='ShaderNodeOutputWorld')   
@@ -717,31 +1054,171 @@ for i in range(len(bed_textire_list)): # BED Texture
         links = node_tree.links
         link = links.new(node_environment.outputs["Color"], node_background.inputs["Color"])
         link = links.new(node_background.outputs["Background"], node_output.inputs["Surface"])
-        
-        #---------------- ANIMATION ----------------
-        for m in range(1,len(parser.layers)-232):
-            verts, edges, props = segments_to_meshdata(parser.layers[m])
-            print('-> verts and edges for L= ',m)
+    # Load and assign the image to the node property
+    node_environment.image = cached_image(path)
+
+
+# layers that get rendered: every k-th, an explicit list and/or a Z range (mm).
+# k counts layer numbers (10, 20, ...), where the old script's ind % 10
+# counted the layer objects it built, so layers without extrusions shifted it
+SAMPLE_EVERY = 10
+SAMPLE_LAYERS = None
+SAMPLE_Z_RANGE = None
+# top layers left out when only SAMPLE_EVERY is set, the old script stopped
+# 232 layers below the top of its sample print
+SAMPLE_SKIP_TOP = 0
+
+def sampled_layers():
+    if STREAM_LAYERS:
+        samples = sample_layers(layer_z, SAMPLE_EVERY, SAMPLE_LAYERS, SAMPLE_Z_RANGE)
+        count = len(layer_z)
+    else:
+        samples = parser.sampleLayers(SAMPLE_EVERY, SAMPLE_LAYERS, SAMPLE_Z_RANGE)
+        count = len(parser.layers)
+    if SAMPLE_LAYERS is None and SAMPLE_Z_RANGE is None:
+        samples = samples[samples < count-SAMPLE_SKIP_TOP]
+    return samples
+
+
+def layer_groups(lasts):
+    # (first, last, segments, z_below) of the layers after one of lasts up to
+    # the next, z_below being the Z under layer first; streamed from the
+    # file with STREAM_LAYERS
+    if not STREAM_LAYERS:
+        first = 1
+        for m in lasts:
+            below = parser.layers[first-1]["Z"]
+            yield first, m, parser.segments[parser.layers[first].start:parser.layers[m].stop], float(below[-1]) if len(below) else 0.0
+            first = m+1
+        return
+    lasts = list(lasts)
+    first, parts, z_last, z_below = 1, [], 0.0, 0.0
+    for i, layer in enumerate(parser.iter_layers(GCODE_PATH)):
+        if i == first:
+            z_below = z_last
+        if i >= first:
+            parts.append(layer)
+        z_last = float(layer["Z"][-1]) if len(layer) else z_last
+        if i == lasts[0]:
+            if len(parts) > 1:
+                columns = {name: np.concatenate([part[name] for part in parts]) for name, _ in SegmentTable.COLUMNS}
+                parts = [SegmentTable.fromColumns(columns).view()]
+            yield first, i, parts[0], z_below
+            first, parts = i+1, []
+            lasts.pop(0)
+            if not lasts:
+                return
+
+
+def build_layers():
+    # the print geometry animated in every bed x HDRI job, for the sampled
+    # layers only: the layers after one sample up to the next become one
+    # object, and nothing above the last sample is built; returns the samples
+    if "Layers" in bpy.data.collections:
+        del_collection(bpy.data.collections["Layers"])
+        purge_orphans()
+    samples = sampled_layers()
+    if len(samples) == 0:
+        return samples
+    if BATCHED_MESH:
+        # layer 0 holds what comes before the first ;LAYER_CHANGE; a streamed
+        # print is converted one layer at a time
+        lasts = np.arange(1, samples[-1]+1) if STREAM_LAYERS else samples[-1:]
+        pieces = ((simplified(group, table["frames"]["camera"]), z_below)
+                  for first, m, group, z_below in layer_groups(lasts))
+        process_print(print_from_meshdata('print',pieces,"Layers"))
+    else:
+        for first, m, group, z_below in layer_groups(samples):
+            group = simplified(group, table["frames"]["camera"])
+            verts, edges, props = segments_to_meshdata(group)
+            print('-> verts and edges for L= ',first,'..',m)
             if(len(edges)>0):
-                obj_from_pydata('layer_'+str(m),verts,edges,True,"Layers")
-    
-        LINE_HEIGHT = 0.26
+                obj = obj_from_pydata('layer_'+str(m),verts,edges,True,"Layers")
+                feature_attribute(obj,props)
+                obj["last_layer"] = int(m)
+                set_point_attributes(obj,*point_attributes(group,z_below))
+
         process_layers()
-        animate_layers(keyframe_runner*48) # 333/25 = 13.32
-        #-----------------------------------------
-        
+    return samples
+
+
+def matrix_jobs(samples):
+    # one job per bed x HDRI pair: which textures, the frame its animation
+    # starts after and the layers it renders
+    jobs = []
+    keyframe_runner = 1
+    for i in range(len(bed_textire_list)): # BED Texture
+        for j in range(len(hdri_textire_list)): # HDRI Env.
+            keyframe_runner += 1
+            jobs.append({"bed": i, "hdri": j, "start": keyframe_runner*48, # 333/25 = 13.32
+                         "samples": [int(m) for m in samples]})
+    return jobs
+
+
+def place_bed(path,pose):
+    # the bed plane of texture path at pose, its scene table "bed_poses" row
+    so = bed_plane(path)
+    # set coordinates and scale
+    so.location[0] = pose[0]
+    so.location[1] = pose[1]
+    so.location[2] = 0
+    
+    #so.location[2] = -600
+    #so.location[2] = -600
+    #so.location[2] = -600
+    
+    so.rotation_euler[0] = 0 # radians (?)
+    so.rotation_euler[2] = pose[2]
+    #so.scale = (190,190,190)
+    so.scale = (250*so["x_scale"],250,250)
+
+
+# build the geometry once and keep it for every bed x HDRI job, only the
+# world texture and the bed plane change between jobs
+REUSE_GEOMETRY = True
+
+# the table covers the whole matrix, so a farm shard picks its rows from the
+# planned table (or the same one drawn again from the seed)
+jobs = matrix_jobs(sampled_layers())
+table = load_scene_table(SCENE_TABLE or os.path.join(RENDER_DIR, "scene_table.npz"),
+                         jobs, SCENE_SEED, save=not FARM.shard)
+if FARM.plan:
+    with open(FARM.plan, 'w') as f:
+        json.dump(jobs, f)
+    sys.exit(0)
+if FARM.shard:
+    with open(FARM.shard) as f:
+        jobs = json.load(f)["jobs"]
+for mat in [gcode_mat] + feature_mats:
+    mat.node_tree.nodes[color_RGB_1.name].outputs[0].default_value = (*table["colors"][0], 1)
+    mat.node_tree.nodes[color_RGB_2.name].outputs[0].default_value = (*table["colors"][1], 1)
+
+LINE_HEIGHT = 0.26
+if REUSE_GEOMETRY:
+    build_layers()
+
+#--------------------------------------------------
+bed = None
+for job in jobs:
+    if len(job["samples"]) == 0:
+        continue
+    params = job_params(table, job)
+    if job["bed"] != bed:
+        bed = job["bed"]
+        print('BED_NAME=',bed_textire_list[bed])
+        place_bed(bed_textire_list[bed], table["bed_poses"][bed])
+    set_environment(hdri_textire_list[job["hdri"]])
+    
+    #---------------- ANIMATION ----------------
+    if not REUSE_GEOMETRY:
+        build_layers()
+    animate_layers(job["start"], job["samples"], "bed%d_hdri%d" % (job["bed"], job["hdri"]), FARM.output, params)
+    #-----------------------------------------
+    
+    if not REUSE_GEOMETRY:
         # delete all the layers (with keyframes) after rendering
         del_collection(bpy.data.collections["Layers"])
-        # end of j (HDRI Env.)
-        
-
-    sacrificial_cube = bpy.data.collections['Collection'].objects['Cube']
-    sacrificial_cube.select_set(False)
-    # delete bed texture
-    bpy.data.objects[str(bed_name)].select_set(True) # Blender 2.8x
-    # MAKE SURE YOU DESELECTED ALL OTHER OBJECTS
-    bpy.ops.object.delete()
-    # end of i (BED Texture)
+    purge_orphans()
 #--------------------------------------------------
 
 
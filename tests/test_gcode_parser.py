@@ -0,0 +1,44 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main_src_folder"))
+from gcode_parser import Parser, SegmentTable
+
+
+def write_gcode(path, layers=5):
+    # a small square per layer, ;TYPE: and ;LAYER_CHANGE like PrusaSlicer writes them
+    lines = ["G90", "M83", "G1 X10 Y10 F3000"]
+    for n in range(layers):
+        z = 0.2*(n+1)
+        lines += [";LAYER_CHANGE", ";Z:%g" % z, "G1 Z%g F720" % z, ";TYPE:External perimeter"]
+        lines += ["G1 X20 Y10 E0.5", "G1 X20 Y20 E0.5", "G1 X10 Y20 E0.5", "G1 X10 Y10 E0.5"]
+        lines += [";TYPE:Solid infill", "G1 X15 Y15 E0.3", "G0 X10 Y10"]
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def test_iter_layers_twice(tmp_path):
+    path = str(tmp_path / "print.gcode")
+    write_gcode(path)
+    parser = Parser()
+    first = [{name: layer[name].copy() for name, _ in SegmentTable.COLUMNS} for layer in parser.iter_layers(path)]
+    second = [{name: layer[name].copy() for name, _ in SegmentTable.COLUMNS} for layer in parser.iter_layers(path)]
+    assert len(first) == len(second) == 6
+    for a, b in zip(first, second):
+        for name, _ in SegmentTable.COLUMNS:
+            np.testing.assert_array_equal(a[name], b[name])
+
+
+def test_iter_layers_matches_parse(tmp_path):
+    path = str(tmp_path / "print.gcode")
+    write_gcode(path)
+    parser = Parser()
+    parser.parseFile(path)
+    parser.classifySegments()
+    streamed = list(Parser().iter_layers(path))
+    assert len(streamed) == len(parser.layers)
+    for a, b in zip(streamed, parser.layers):
+        for name, _ in SegmentTable.COLUMNS:
+            np.testing.assert_array_equal(a[name], b[name])